@@ -0,0 +1,155 @@
+############################################################################
+# PYBUS BUSES
+# SEVERAL INTERFACES (E.G. I-BUS AND K-BUS ADAPTERS) READ BY ONE THREAD, AND WRITTEN TO BY BUS ID
+#
+# ibusBuses stands in for a single ibusFace as the event driver's WRITER. Reads come from whichever
+# port has data, found with one select over all of them, and every packet carries the id of its bus.
+# Writes go to the bus asked for, or else the bus of the packet whose directive is running (see CURRENT),
+# or else the default (first) bus.
+############################################################################
+
+import time
+import errno
+import select
+import logging
+import threading
+import collections
+
+from pyBus_interface import IDLE_TIMEOUT, RECONNECT_RETRY, CLOSED_PORT_ERRORS
+
+#####################################
+# CONFIG
+#####################################
+CURRENT = threading.local() # CURRENT.bus is the bus writes from this thread go to when none is given
+
+# Send writes from this thread to bus (None for the default) until told otherwise, returns the bus used until now
+def useBus(bus):
+	previous = getattr(CURRENT, "bus", None)
+	CURRENT.bus = bus
+	return previous
+
+#------------------------------------
+# CLASS for a set of interfaces, keyed by bus id
+# faces is a list of (bus id, ibusFace) in order, the first is the default for writes
+#------------------------------------
+class ibusBuses ( object ):
+	def __init__(self, faces):
+		self.FACES = collections.OrderedDict(faces)
+		if not self.FACES:
+			raise ValueError("At least one bus is needed")
+		self.DEFAULT = next(iter(self.FACES))
+		self.ORDER = list(self.FACES.values())
+		self.READING = list(self.ORDER) # faces still worth selecting on, replays drop out once they run dry
+		self.turn = 0 # face the next buffered packet is looked for on first, so one busy bus can't starve the others
+
+	# The interface for a bus id, the current one (see useBus) if None
+	def getFace(self, bus=None):
+		if bus is None:
+			bus = getattr(CURRENT, "bus", None) or self.DEFAULT
+		face = self.FACES.get(bus)
+		if face is None:
+			raise ValueError("Unknown bus {}, expected one of {}".format(bus, ", ".join(self.FACES)))
+		return face
+
+	def getBuses(self):
+		return list(self.FACES)
+
+	# Next packet from any bus, or None once every bus has been quiet for IDLE_TIMEOUT
+	def readBusPacket(self):
+		while True:
+			packet = self.nextBuffered()
+			if packet:
+				return packet
+
+			readable = self.waitForData(IDLE_TIMEOUT)
+			for face in readable:
+				if not face.refill(0) and face.isExhausted():
+					self.READING.remove(face)
+
+			# Partial frames on a bus that has gone quiet (or run dry) will never be completed, look for a valid frame inside them
+			now = time.time()
+			for face in self.ORDER:
+				if len(face.RING) and (now - face.lastRxTime > IDLE_TIMEOUT or face not in self.READING):
+					packet = face.parsePacket(idle=True)
+					if packet:
+						return packet
+
+			if not readable:
+				return None
+
+	# Next packet already buffered on any bus, taking turns between them
+	def nextBuffered(self):
+		faces = self.ORDER
+		count = len(faces)
+		for i in range(count):
+			face = faces[(self.turn + i) % count]
+			packet = face.parsePacket()
+			if packet:
+				self.turn = (self.turn + i + 1) % count
+				return packet
+		return None
+
+	# Faces with data waiting on their port, after waiting up to timeout for any.
+	# Unplugged adapters are left out, and looked for again every RECONNECT_RETRY until they're back
+	def waitForData(self, timeout):
+		online = [face for face in self.READING if face.isOnline()]
+		if len(online) < len(self.READING):
+			timeout = min(timeout, RECONNECT_RETRY)
+		if not online:
+			if self.READING:
+				time.sleep(timeout)
+			return []
+
+		waiting = [face for face in online if face.waitingBytes()]
+		if waiting:
+			return waiting
+
+		try:
+			byFd = dict((face.SDEV.fileno(), face) for face in online)
+			readable, _, _ = select.select(list(byFd), [], [], timeout)
+		except select.error, e:
+			if e.args[0] in (errno.EINTR, errno.EBADF):
+				return [] # EBADF: a port was closed under us, it's left out next time round
+			raise
+		except CLOSED_PORT_ERRORS:
+			return [] # a port closed between checking it was online and fileno() (ValueError on older pyserial)
+		return [byFd[fd] for fd in readable]
+
+	# Write a packet to a bus, see ibusFace.writeBusPacket
+	def writeBusPacket(self, src, dst, data, wait=True, bus=None):
+		return self.getFace(bus).writeBusPacket(src, dst, data, wait)
+
+	def waitClearBus(self):
+		for face in self.FACES.values():
+			face.waitClearBus()
+
+	# Whether every bus has run dry, which only happens when replaying
+	def isExhausted(self):
+		return all(face.isExhausted() for face in self.FACES.values())
+
+	# With more than one bus, each is captured into its own sub directory of directory
+	def startCapture(self, directory, **kwargs):
+		for bus, face in self.FACES.items():
+			face.startCapture(directory if len(self.FACES) == 1 else "{}/{}".format(directory, bus), **kwargs)
+
+	def stopCapture(self):
+		for face in self.FACES.values():
+			face.stopCapture()
+
+	# Frame counters summed over every bus
+	def getStats(self):
+		stats = collections.Counter()
+		for face in self.FACES.values():
+			stats.update(face.getStats())
+		return dict(stats)
+
+	# {bus id : frame counters}
+	def getBusStats(self):
+		return dict((bus, face.getStats()) for bus, face in self.FACES.items())
+
+	def close(self):
+		for bus, face in self.FACES.items():
+			try:
+				face.close()
+			except Exception, e:
+				logging.error("Failed to close bus {}: {}".format(bus, e))
@@ -0,0 +1,216 @@
+############################################################################
+# PYBUS CAPTURE
+# COMPACT BINARY RECORDING OF EVERY FRAME READ FROM THE BUS
+#
+# A capture file is a header followed by fixed size chunks:
+#   header : magic 'PBCAP1', version, chunk size, monotonic and wall clock time at creation
+#   chunk  : index block ('IX', timestamp of the first record, chunk number), then records
+#   record : timestamp (uint32, 100us ticks since the header time), frame length (uint8), raw frame
+# A record never crosses into the next chunk, a zero length pads out the rest of the chunk.
+# Since every chunk starts at a known offset with its first timestamp, a time range is found
+# by binary searching the index blocks through mmap, without reading the records in between.
+############################################################################
+
+import os
+import time
+import mmap
+import ctypes
+import struct
+import logging
+
+#####################################
+# CONFIG
+#####################################
+CHUNK_SIZE = 16 * 1024 # bytes between index blocks
+MAX_BYTES = 8 * 1024 * 1024 # size a capture file is rotated at
+MAX_FILES = 20 # older captures past this many are deleted
+FLUSH_INTERVAL = 5 # seconds between flushes to disk
+TICK = 0.0001 # seconds per timestamp unit
+
+MAGIC = "PBCAP1"
+VERSION = 1
+HEADER = struct.Struct("<6sHIdd4x") # magic, version, chunk size, base monotonic time, base wall clock time
+INDEX = struct.Struct("<2s2xII") # 'IX', first timestamp in chunk, chunk number
+RECORD = struct.Struct("<IB") # timestamp, frame length
+FILE_SUFFIX = ".pbcap"
+
+#####################################
+# MONOTONIC CLOCK
+#####################################
+# Python 2 doesn't have time.monotonic, so ask libc directly where we can
+class timespec(ctypes.Structure):
+	_fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+def _libcMonotonic(library):
+	clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+	clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+	def monotonic():
+		t = timespec()
+		clock_gettime(1, ctypes.pointer(t)) # CLOCK_MONOTONIC
+		return t.tv_sec + t.tv_nsec * 1e-9
+	return monotonic
+
+try:
+	monotonic = time.monotonic
+except AttributeError:
+	monotonic = time.time
+	for library in ("librt.so.1", "libc.so.6"):
+		try:
+			monotonic = _libcMonotonic(library)
+			break
+		except (OSError, AttributeError):
+			pass
+
+#------------------------------------
+# CLASS for writing rotating capture files
+#------------------------------------
+class ibusCaptureWriter ( ):
+	def __init__(self, directory, maxBytes=MAX_BYTES, maxFiles=MAX_FILES, chunkSize=CHUNK_SIZE):
+		self.DIRECTORY = directory
+		self.MAX_BYTES = max(maxBytes, chunkSize)
+		self.MAX_FILES = maxFiles
+		self.CHUNK_SIZE = chunkSize
+		self.FILE = None
+		self.path = None
+		self.open()
+
+	# Start a new capture file
+	def open(self):
+		if not os.path.isdir(self.DIRECTORY):
+			os.makedirs(self.DIRECTORY)
+
+		name = "pybus-{}".format(time.strftime("%Y%m%d-%H%M%S"))
+		self.path = os.path.join(self.DIRECTORY, name + FILE_SUFFIX)
+		count = 1
+		while os.path.exists(self.path): # rotated more than once within a second
+			self.path = os.path.join(self.DIRECTORY, "{}-{}{}".format(name, count, FILE_SUFFIX))
+			count += 1
+		self.FILE = open(self.path, "wb")
+		self.baseTime = monotonic()
+		self.FILE.write(HEADER.pack(MAGIC, VERSION, self.CHUNK_SIZE, self.baseTime, time.time()))
+		self.size = HEADER.size
+		self.chunk = -1
+		self.chunkLeft = 0
+		self.lastFlush = self.baseTime
+		logging.info("Capturing bus traffic to {}".format(self.path))
+		self.prune()
+
+	# Append one frame. Cheap enough for the reader thread: a pack and a buffered write
+	def record(self, frame, timestamp=None):
+		if timestamp is None:
+			timestamp = monotonic()
+		ticks = int((timestamp - self.baseTime) / TICK) & 0xFFFFFFFF
+		length = len(frame)
+		needed = RECORD.size + length
+
+		if needed > self.chunkLeft:
+			if self.size + self.chunkLeft + self.CHUNK_SIZE > self.MAX_BYTES:
+				self.rotate()
+				ticks = int((timestamp - self.baseTime) / TICK) & 0xFFFFFFFF
+			self.startChunk(ticks)
+
+		self.FILE.write(RECORD.pack(ticks, length) + bytes(frame))
+		self.chunkLeft -= needed
+		self.size += needed
+
+		if timestamp - self.lastFlush > FLUSH_INTERVAL:
+			self.FILE.flush()
+			self.lastFlush = timestamp
+
+	# Pad out the current chunk and start the next one with its index block
+	def startChunk(self, ticks):
+		if self.chunk >= 0 and self.chunkLeft:
+			self.FILE.write("\0" * self.chunkLeft)
+			self.size += self.chunkLeft
+		self.chunk += 1
+		self.FILE.write(INDEX.pack("IX", ticks, self.chunk))
+		self.size += INDEX.size
+		self.chunkLeft = self.CHUNK_SIZE - INDEX.size
+
+	def rotate(self):
+		self.FILE.close()
+		self.open()
+
+	# Delete the oldest captures past MAX_FILES
+	def prune(self):
+		captures = []
+		for name in os.listdir(self.DIRECTORY):
+			if name.startswith("pybus-") and name.endswith(FILE_SUFFIX):
+				path = os.path.join(self.DIRECTORY, name)
+				captures.append((os.path.getmtime(path), path))
+		captures.sort()
+
+		for mtime, path in captures[:-self.MAX_FILES]:
+			try:
+				os.remove(path)
+			except OSError, e:
+				logging.warning("Failed to remove old capture {}: {}".format(path, e))
+
+	def close(self):
+		if self.FILE:
+			self.FILE.close()
+			self.FILE = None
+
+#------------------------------------
+# CLASS for reading a capture file through mmap
+#------------------------------------
+class ibusCaptureReader ( ):
+	def __init__(self, path):
+		self.PATH = path
+		self.FILE = open(path, "rb")
+		size = os.fstat(self.FILE.fileno()).st_size
+		if size < HEADER.size:
+			raise ValueError("{} is too short to be a capture".format(path))
+
+		self.MAP = mmap.mmap(self.FILE.fileno(), size, access=mmap.ACCESS_READ)
+		magic, version, self.CHUNK_SIZE, self.baseTime, self.baseWallTime = HEADER.unpack_from(self.MAP, 0)
+		if magic != MAGIC:
+			raise ValueError("{} is not a capture file".format(path))
+		self.size = size
+		# Only count chunks whose index block made it to disk
+		self.chunks = 0
+		if size >= HEADER.size + INDEX.size:
+			self.chunks = (size - HEADER.size - INDEX.size) // self.CHUNK_SIZE + 1
+
+	# Timestamp (seconds, on the capture's monotonic clock) of a chunk's first record
+	def chunkTime(self, chunk):
+		marker, ticks, number = INDEX.unpack_from(self.MAP, HEADER.size + chunk * self.CHUNK_SIZE)
+		return self.baseTime + ticks * TICK
+
+	# First chunk that may hold records at or after timestamp
+	def findChunk(self, timestamp):
+		low, high = 0, self.chunks
+		while low < high:
+			mid = (low + high) // 2
+			if self.chunkTime(mid) <= timestamp:
+				low = mid + 1
+			else:
+				high = mid
+		return max(low - 1, 0)
+
+	# Yields (timestamp, frame) for every record, optionally only those between start and end (capture monotonic times)
+	def frames(self, start=None, end=None):
+		chunk = self.findChunk(start) if start is not None else 0
+		while chunk < self.chunks:
+			offset = HEADER.size + chunk * self.CHUNK_SIZE
+			chunkEnd = min(offset + self.CHUNK_SIZE, self.size)
+			offset += INDEX.size
+			while offset + RECORD.size <= chunkEnd:
+				ticks, length = RECORD.unpack_from(self.MAP, offset)
+				if not length:
+					break # padding, rest of the chunk is empty
+				offset += RECORD.size
+				if offset + length > chunkEnd:
+					break # cut short, the capture was still being written
+				timestamp = self.baseTime + ticks * TICK
+				if end is not None and timestamp > end:
+					return
+				if start is None or timestamp >= start:
+					yield timestamp, bytearray(self.MAP[offset:offset + length])
+				offset += length
+			chunk += 1
+
+	def close(self):
+		self.MAP.close()
+		self.FILE.close()
@@ -1,5 +1,6 @@
 import pyBus_eventDriver as main
 import pyBus_utilities as utils
+import pyBus_signals as signals # Declarative decoders for broadcast messages
 
 #####################################
 # GLOBALS
@@ -148,9 +149,7 @@ LIST = {
 			'ALL' : 'd_vehicleData'
 		},
 		'BF' : {
-			'5B6100040001' : None, # lights turned on (including interior)
-			'5B0100000001' : None, # lights turned off (including interior)
-			'5B6000040000' : None # Indicator_Left Indicator_Right Indicator_sync  All_OK
+			'5B' : 'd_lampStatus' # Lamp status, e.g. 5B6100040001 lights on, 5B6000040000 both indicators
 		}
 	},
 	'E8' : {
@@ -182,7 +181,7 @@ def d_ignitionOff(packet):
 
 def d_keyDetected(packet):
 	main.SESSION.updateData("KEY_DETECTED", True)
-	main.SESSION.updateData("LAST_KEY_USED", packet['dat'][-1])
+	main.SESSION.updateData("LAST_KEY_USED", packet.byteHex(-1))
 
 def d_keyNotDetected(packet):
 	main.SESSION.updateData("KEY_DETECTED", False)
@@ -206,7 +205,7 @@ def d_topClosed(packet):
 # Called when sunroof / convertible top is open. Last packet is state / progress of opening
 def d_topOpen(packet):
 	main.SESSION.updateData("CONVERTIBLE_TOP_OPEN", True)
-	main.SESSION.updateData("CONVERTIBLE_TOP_PROGRESS", packet['dat'][-1])
+	main.SESSION.updateData("CONVERTIBLE_TOP_PROGRESS", packet.byteHex(-1))
 
 # Whatever aux heating is
 def d_auxHeatingOff(packet):
@@ -214,17 +213,17 @@ def d_auxHeatingOff(packet):
 
 # Called when driver seat memory buttons are pushed
 def d_seatMemory(packet):
-	if packet['dat'][1] == "00":
+	if packet.dat[1] == 0x00:
 		main.SESSION.updateData("SEAT_MEMORY_PUSHED", True)
 	else:
-		if packet['dat'][1] == "01": 
+		if packet.dat[1] == 0x01: 
 			seatMemory = "SEAT_MEMORY_1"
-		elif packet['dat'][1] == "02": 
+		elif packet.dat[1] == 0x02: 
 			seatMemory = "SEAT_MEMORY_2"
-		elif packet['dat'][1] == "04": 
+		elif packet.dat[1] == 0x04: 
 			seatMemory = "SEAT_MEMORY_3"
 
-		if main.SESSION.data["SEAT_MEMORY_PUSHED"]:
+		if main.SESSION.get("SEAT_MEMORY_PUSHED"):
 			main.SESSION.updateData("SEAT_MEMORY_PUSHED", False)
 			main.SESSION.updateData(seatMemory, True)
 
@@ -244,169 +243,59 @@ def d_carUnlocked(packet = None):
 # This isn't very often, especially on coupe models
 def d_passengerDoorLocked(packet):
 	main.SESSION.updateData("DOOR_LOCKED_PASSENGER", True)
-	if "DOOR_LOCKED_DRIVER" in main.SESSION.data and main.SESSION.data["DOOR_LOCKED_DRIVER"]:
+	if main.SESSION.get("DOOR_LOCKED_DRIVER"):
 		main.SESSION.updateData("DOORS_LOCKED", True)
 
 # Called when ONLY DRIVER door is locked
 # This isn't very often, especially on coupe models
 def d_driverDoorLocked(packet):
 	main.SESSION.updateData("DOOR_LOCKED_DRIVER", True)
-	if "DOOR_LOCKED_PASSENGER" in main.SESSION.data and main.SESSION.data["DOOR_LOCKED_PASSENGER"]:
+	if main.SESSION.get("DOOR_LOCKED_PASSENGER"):
 		main.SESSION.updateData("DOORS_LOCKED", True)
 
 # This packet is used to parse all messages from the IKE (instrument control electronics), as it contains speed/RPM info. 
-# But the data for speed/rpm will vary, so it must be parsed via a method linked to 'ALL' data in the JSON DIRECTIVES
+# What each message carries is declared in pyBus_signals.IKE
 def d_custom_IKE(packet):
-	packetData = packet['dat']
-
-	# Ignition Status
-	if packetData[0] == '11':
-		if (packetData[1] == '00'): # Key Out.
-			main.SESSION.updateData("KEY_STATE", False)
-		elif (packetData[1] == '01'): # Pos 1
-			main.SESSION.updateData("KEY_STATE", "POS_1")
-		elif (packetData[1] == '03'): # Pos 2
-			main.SESSION.updateData("KEY_STATE", "POS_2")
-		elif (packetData[1] == '07'): # Start
-			main.SESSION.updateData("KEY_STATE", "START")
-
-	# Sensor Status, broadcasted every 10 seconds
-	elif packetData[0] == '13':
-		# Haven't decoded this one yet
-		if ''.join(packetData) == "1303000000000014":
-			main.SESSION.updateData("HANDBRAKE", True)
-			main.SESSION.updateData("OIL_PRESSURE", "LOW")
-
-		main.SESSION.updateData("IKE_SENSOR_STATUS", (packetData[1]+packetData[2]+packetData[3]+packetData[4]+packetData[5]+packetData[6]+packetData[7]))
-
-		# Byte 7 holds temp in c
-		main.SESSION.updateData("OUTSIDE_TEMP_2", int(packetData[7], 16))
-
-	# Odometer reading, in response to request
-	elif packetData[0] == '17':
-		main.SESSION.updateData("ODOMETER", int(packetData[3]+packetData[2]+packetData[1], 16))
-
-	# Speed / RPM Info, broadcasted every 2 seconds
-	elif packetData[0] == '18':
-		speed = int(packetData[1], 16) * 2
-		revs = int(packetData[2], 16)
-
-		main.SESSION.updateData("SPEED", speed)
-		main.SESSION.updateData("RPM", revs*100)
-
-	# Temperature Status, broadcasted every 10 seconds
-	elif packetData[0] == '19':
-		main.SESSION.updateData("OUTSIDE_TEMP", int(packetData[1], 16))
-		if int(packetData[2], 16) != 128:
-			main.SESSION.updateData("COOLANT_TEMP", int(packetData[2], 16))
-
-		# Only for european models I believe, or if you've set this to be tracked with INPA/NCS. Otherwise 0
-		main.SESSION.updateData("OIL_TEMP", int(packetData[3], 16))
-
-	# OBC Estimated Range / Average Speed
-	elif packetData[0] == '24':
-		if (packetData[1] == '06'):
-			main.SESSION.updateData("RANGE_KM", int((packetData[3]+packetData[4]+packetData[5]+packetData[6]), 16))
-		elif (packetData[1] == '0A'):
-			main.SESSION.updateData("AVG_SPEED", int((packetData[3]+packetData[4]+packetData[5]+packetData[6]), 16))
-
-# Handles Vehicle data, like VIN and service info
-def d_vehicleData(packet):
-	packetData = packet['dat']
-
-	if packetData[0] == 54 and len(packet >= 14):
-		# VIN number is in plaintext, first two model letters are ASCII
-		main.SESSION.updateData("VIN", (packetData[1].decode('hex')+packetData[2].decode('hex')+packetData[3]+packetData[4]+packetData[5][0]))
-
-		# Odometer, rounded to the nearest hundred in KM
-		main.SESSION.updateData("ODOMETER_ESTIMATE", 100*int((packetData[6]+packetData[7]), 16))
+	signals.IKE.update(main.SESSION.updateData, packet.dat)
+	signals.IKE_SENSORS.update(main.SESSION.updateData, packet.dat, packet.bus)
 
-		# Liters since last service, first byte and first 4 bits in second byte
-		# I.E. '58 02' would be 88+0 or 880 liters
-		main.SESSION.updateData("LITERS_SINCE_LAST_SERVICE", str(int((packetData[9]), 16))+str(int((packetData[10][0]), 16)))
-
-		# Days since last service
-		main.SESSION.updateData("DAYS_SINCE_LAST_SERVICE", int((packetData[12]+packetData[13]), 16))
+# Handles Vehicle data, like VIN and service info, see pyBus_signals.VEHICLE_DATA
+def d_vehicleData(packet):
+	signals.VEHICLE_DATA.update(main.SESSION.updateData, packet.dat)
 
-# Handles messages sent when door/window status changes
-# binary 1 if open, 0 if closed
+# Handles messages sent when door/window status changes, see pyBus_signals.DOORS_WINDOWS
+# Only what changed since the last message is updated
 def d_windowDoorMessage(packet):
-	packetData = packet['dat']
-	doorByte = utils.hex2bin(packetData[1])
-	windowByte = utils.hex2bin(packetData[2])
-
-	if doorByte[2]: d_carLocked()
-	if doorByte[3]: d_carUnlocked()
-
-	# Bits 4 and 5 are likely rear passenger / rear driver door respectively 
-	# Unused in coupes / convertibles obviously
-	if doorByte[6]: main.SESSION.updateData("DOOR_OPEN_PASSENGER", True)
-	else: main.SESSION.updateData("DOOR_OPEN_PASSENGER", False)
-
-	if doorByte[7]: main.SESSION.updateData("DOOR_OPEN_DRIVER", True)
-	else: main.SESSION.updateData("DOOR_OPEN_DRIVER", False)
-
-	if windowByte[1]: main.SESSION.updateData("HOOD_OPEN", True)
-	else: main.SESSION.updateData("HOOD_OPEN", False)
-
-	if windowByte[4]: main.SESSION.updateData("WINDOW_OPEN_PASSENGER_REAR", True)
-	else: main.SESSION.updateData("WINDOW_OPEN_PASSENGER_REAR", False)
-
-	if windowByte[5]: main.SESSION.updateData("WINDOW_OPEN_DRIVER_REAR", True)
-	else: main.SESSION.updateData("WINDOW_OPEN_DRIVER_REAR", False)
-
-	if windowByte[6]: main.SESSION.updateData("WINDOW_OPEN_PASSENGER_FRONT", True)
-	else: main.SESSION.updateData("WINDOW_OPEN_PASSENGER_FRONT", False)
-
-	if windowByte[7]: main.SESSION.updateData("WINDOW_OPEN_DRIVER_FRONT", True)
-	else: main.SESSION.updateData("WINDOW_OPEN_DRIVER_FRONT", False)
+	changes = signals.DOORS_WINDOWS.changes(packet.dat, packet.bus)
+	if not changes:
+		return
+
+	for key, value in changes:
+		if key == "LOCKED":
+			if value: d_carLocked()
+		elif key == "UNLOCKED":
+			if value: d_carUnlocked()
+		else:
+			main.SESSION.updateData(key, value)
 
 	# Re-evaluate aggregate window / door data
 	meta_evalWindowDoor()
 
+# Handles lamp status from the LCM, see pyBus_signals.LAMP_STATUS
+def d_lampStatus(packet):
+	signals.LAMP_STATUS.update(main.SESSION.updateData, packet.dat, packet.bus)
 
-# Handles Rain/Light sensor data.
+# Handles Rain/Light sensor data, see pyBus_signals.RAIN_LIGHT_SENSOR
 def d_rainLightSensor(packet):
-	packetData = packet['dat']
-
-	if packetData[0] == '59':
-		# Decode first packet (reason)
-		if packetData[2] == '01':
-			main.SESSION.updateData("LIGHT_SENSOR_REASON", "TWILIGHT")
-		elif packetData[2] == '02':
-			main.SESSION.updateData("LIGHT_SENSOR_REASON", "DARKNESS")
-		elif packetData[2] == '04':
-			main.SESSION.updateData("LIGHT_SENSOR_REASON", "RAIN")
-		elif packetData[2] == '08':
-			main.SESSION.updateData("LIGHT_SENSOR_REASON", "TUNNEL")
-		elif packetData[2] == '10':
-			main.SESSION.updateData("LIGHT_SENSOR_REASON", "BASEMENT_GARAGE")
-
-		# Decode second nibble of second packet (on / off)
-		if packetData[1][1] == '1':
-			main.SESSION.updateData("LIGHT_SENSOR_ON", True)
-		elif packetData[1][1] == '0':
-			main.SESSION.updateData("LIGHT_SENSOR_ON", False)
-
-		# Decode first nibble of second packet (intensity)
-		main.SESSION.updateData("LIGHT_SENSOR_INTENSITY", packetData[1][0])
-
-	main.SESSION.updateData("RAIN_LIGHT_SENSOR_STATUS", (''.join(packet['dat'])))
-
-# Handles raw climate control (Integrated Heating And Air Conditioning) data
-def d_climateControl(packet):
-	packetData = ''.join(packet['dat'])
+	signals.RAIN_LIGHT_SENSOR.update(main.SESSION.updateData, packet.dat)
 
-	if(packetData == "830000"):
-		main.SESSION.updateData("AIR_CONDITIONING_ON", False)
-	elif(packetData == "838008"):
-		main.SESSION.updateData("AIR_CONDITIONING_ON", True)
-	else: 
-		main.SESSION.updateData("CLIMATE_CONTROL_STATUS", (''.join(packet['dat'])))
+# Handles raw climate control (Integrated Heating And Air Conditioning) data, see pyBus_signals.CLIMATE_CONTROL
+def d_climateControl(packet):
+	signals.CLIMATE_CONTROL.update(main.SESSION.updateData, packet.dat)
 
 # Handles any unknown diagnostic packets for logging
 def d_diagnostic(packet):
-	main.SESSION.updateData("DIAGNOSTIC", (''.join(packet['dat'])))
+	main.SESSION.updateData("DIAGNOSTIC", packet.datHex())
 
 def d_togglePause(packet):
 	if main.MEDIA_HOST: 
@@ -444,23 +333,84 @@ def d_steeringSpeakLong(packet):
 # Re-evaluate aggregate window / door data
 def meta_evalWindowDoor():
 	# check for nil values first, should not eval those as false
-	if main.SESSION.data["DOOR_OPEN_PASSENGER"] is not None and main.SESSION.data["DOOR_OPEN_DRIVER"] is not None:
-		if not main.SESSION.data["DOOR_OPEN_PASSENGER"] and not main.SESSION.data["DOOR_OPEN_DRIVER"]:
-			main.SESSION.updateData("DOORS_OPEN", False)
-		else:
-			main.SESSION.updateData("DOORS_OPEN", True)
-
-	if (main.SESSION.data["WINDOW_OPEN_DRIVER_FRONT"] is not None 
-	and main.SESSION.data["WINDOW_OPEN_DRIVER_REAR"] is not None 
-	and main.SESSION.data["WINDOW_OPEN_PASSENGER_FRONT"] is not None 
-	and main.SESSION.data["WINDOW_OPEN_PASSENGER_REAR"] is not None):
-		if (not main.SESSION.data["WINDOW_OPEN_DRIVER_FRONT"] 
-		and not main.SESSION.data["WINDOW_OPEN_DRIVER_REAR"] 
-		and not main.SESSION.data["WINDOW_OPEN_PASSENGER_FRONT"] 
-		and not main.SESSION.data["WINDOW_OPEN_PASSENGER_REAR"]):
-			main.SESSION.updateData("WINDOWS_OPEN", False)
-		else:
-			main.SESSION.updateData("WINDOWS_OPEN", True)
+	doors = [main.SESSION.get(key) for key in ("DOOR_OPEN_PASSENGER", "DOOR_OPEN_DRIVER")]
+	if None not in doors:
+		main.SESSION.updateData("DOORS_OPEN", any(doors))
+
+	windows = [main.SESSION.get(key) for key in ("WINDOW_OPEN_DRIVER_FRONT", "WINDOW_OPEN_DRIVER_REAR", "WINDOW_OPEN_PASSENGER_FRONT", "WINDOW_OPEN_PASSENGER_REAR")]
+	if None not in windows:
+		main.SESSION.updateData("WINDOWS_OPEN", any(windows))
 
 def getDirectives():
-	return globals()
\ No newline at end of file
+	return globals()
+
+############################################################################
+# DISPATCH TABLE
+# LIST is compiled once at startup into a flat dict keyed by (src, dst) ints.
+# Each entry is a directiveRoute, which resolves packet data to a directive by
+# longest prefix match, so entries like '7D00' also catch '7D0004'.
+############################################################################
+
+NO_MATCH = object() # marks a trie node that no LIST entry ends on
+
+class directiveRoute ( object ):
+	__slots__ = ('all', 'other', 'trie')
+
+	def __init__(self):
+		self.all = NO_MATCH
+		self.other = NO_MATCH
+		self.trie = [NO_MATCH, {}] # [directive ending here, {next byte : child node}]
+
+	# Directive for this data: ALL wins, then the longest matching entry, then OTHER. None means ignore the packet
+	def match(self, data):
+		if self.all is not NO_MATCH:
+			return self.all
+
+		found = NO_MATCH
+		node = self.trie
+		for b in data:
+			node = node[1].get(b)
+			if node is None:
+				break
+			if node[0] is not NO_MATCH:
+				found = node[0]
+
+		if found is NO_MATCH:
+			found = self.trie[0] if self.trie[0] is not NO_MATCH else self.other
+		return None if found is NO_MATCH else found
+
+	def add(self, data, directive):
+		node = self.trie
+		for b in data:
+			node = node[1].setdefault(b, [NO_MATCH, {}])
+		node[0] = directive
+
+# Build the dispatch table, resolving directive names to functions. Unknown names are reported here, once, and ignored
+def compileDirectives(directiveList=None):
+	if directiveList is None:
+		directiveList = LIST
+	known = getDirectives()
+	table = {}
+
+	for src, dsts in directiveList.items():
+		for dst, entries in dsts.items():
+			route = table.setdefault((int(src, 16), int(dst, 16)), directiveRoute())
+			for data, methodName in entries.items():
+				directive = None
+				if methodName:
+					directive = known.get(methodName, None)
+					if not callable(directive):
+						main.logging.warning("Method (%s) does not exist, ignoring %s -> %s : %s" % (methodName, src, dst, data))
+						directive = None
+
+				if data == 'ALL':
+					route.all = directive
+				elif data == 'OTHER':
+					route.other = directive
+				else:
+					try:
+						route.add(bytearray.fromhex(data), directive)
+					except ValueError:
+						main.logging.warning("Bad data (%s) in directives for %s -> %s, ignoring" % (data, src, dst))
+
+	return table
\ No newline at end of file
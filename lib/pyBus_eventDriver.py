@@ -7,6 +7,7 @@ import json
 import signal
 import random
 import logging
+import threading
 import traceback
 import datetime
 import requests
@@ -16,35 +17,53 @@ import ast
 import pyBus_session as pB_session # Session object for writing and sending log info abroad
 import pyBus_utilities as utils
 import pyBus_directives as directives
+import pyBus_workerPool as pB_workers # Runs directives off the reader thread
+import pyBus_http as pB_http # Pooled keep-alive HTTP client
+import pyBus_spool as pB_spool # On-disk spool for session updates
+import pyBus_metrics as pB_metrics # Counters and histograms for /metrics
+import pyBus_trace as pB_trace # In-memory trace of recent bus events
+import pyBus_timeseries as pB_series # History of numeric session values
+import pyBus_buses as pB_buses # Routes writes to the bus a packet came from
 
-# This module will read a packet, match it against the json object 'DIRECTIVES' below. 
+from pyBus_interface import LOCATIONS
+
+# This module will read a packet, match it against the 'LIST' object in pyBus_directives.
 # The packet is checked by matching the source value in packet (i.e. where the packet came from) to a key in the object if possible
 # Then matching the Destination if possible
-# The joining the 'data' component of the packet and matching that if possible.
+# Then matching the 'data' component of the packet against the longest entry it starts with.
 # The resulting value will be the name of a function to pass the packet to for processing of sorts.
+# LIST is compiled into DISPATCH once at init, so none of this is string work per packet.
 
 #####################################
 # CONFIG
 #####################################
-TICK = 0.04 # sleep interval in seconds used between iBUS reads
+ERROR_DELAY = 1 # seconds to back off after an unexpected error in the listen loop, so a dead port doesn't spin
 
 #####################################
 # Define Globals
 #####################################
 WRITER = None
 SESSION = None
+SERIES = None # pB_series.ibusTimeSeries fed by SESSION, None if turned off
+DISPATCH = {} # directives.LIST compiled by (src, dst), see directives.compileDirectives
+WORKERS = None # pool running directives, if None they run inline on the reader thread
 WITH_API = False
+STOP = threading.Event() # set to have the listen loop return, see stopListening
 MEDIA_HOST = "http://localhost:5353"
 
+DIRECTIVE_LATENCY = pB_metrics.histogram("pybus_directive_seconds", "Time spent in each directive, its count is the number of calls", "directive")
+DIRECTIVE_ERRORS = pB_metrics.counter("pybus_directive_errors_total", "Exceptions raised from each directive", "directive")
+
 #####################################
 # FUNCTIONS
 #####################################
-# Set the WRITER object (the iBus interface class) to an instance passed in from the CORE module
+# Set the WRITER object (the iBus interface class, or pB_buses.ibusBuses for several) to an instance passed in from the CORE module
 def init(writer, args):
-	global WRITER, SESSION, WITH_API
+	global WRITER, SESSION, SERIES, WITH_API, DISPATCH, WORKERS
+	STOP.clear()
 
 	# Determine if we're extending functionality with external MDroid-Core API
-	if args and args["with_api"]:
+	if args and args.get("with_api"):
 		WITH_API = args["with_api"]
 	else:
 		if args:
@@ -55,8 +74,36 @@ def init(writer, args):
 	# Start ibus writer
 	WRITER = writer
 
+	# Compile directives once, so unknown names are caught now rather than per packet
+	DISPATCH = directives.compileDirectives()
+
+	# Shared keep-alive HTTP client for MDroid-Core and the media host
+	args = args or {}
+	pB_http.configure(
+		connectTimeout=args.get("connect_timeout", pB_http.CONNECT_TIMEOUT),
+		readTimeout=args.get("read_timeout", pB_http.READ_TIMEOUT),
+		poolSize=args.get("pool_size", pB_http.POOL_SIZE)
+	)
+
+	# Directives make blocking HTTP calls, so they run on a worker pool rather than the reader thread
+	WORKERS = pB_workers.ibusWorkerPool(
+		workers=int(args.get("workers", pB_workers.WORKERS)),
+		depth=int(args.get("queue_depth", pB_workers.QUEUE_DEPTH)),
+		policy=args.get("drop_policy", pB_workers.DROP_OLDEST)
+	)
+
+	# History of numeric values for charting, in bounded memory
+	maxKeys = int(args.get("timeseries_max_keys", pB_series.MAX_KEYS))
+	SERIES = pB_series.ibusTimeSeries(maxKeys) if maxKeys else None
+
 	# Start PyBus logging Session
-	SESSION = pB_session.ibusSession(WITH_API)
+	SESSION = pB_session.ibusSession(
+		WITH_API,
+		rateLimits=args.get("rate_limits"),
+		spoolPath=args.get("spool_path", pB_spool.SPOOL_PATH),
+		spoolMaxBytes=args.get("spool_max_bytes", pB_spool.MAX_BYTES),
+		series=SERIES
+	)
 
 	# Turn on the 'clown nose' for 3 seconds
 	utils.turnOnClownNose()
@@ -65,59 +112,63 @@ def init(writer, args):
 	now = datetime.datetime.now()
 	utils.setTime(now.day, now.month, now.year, now.hour, now.minute)
 
-# Manage the packet, meaning traverse the JSON 'DIRECTIVES' object and attempt to determine a suitable function to pass the packet to.
+# Manage the packet, meaning look up the directive compiled for its src / dst and data, and pass the packet to it.
+# The directive is queued on the worker pool, so this never waits on it.
 def manage(packet):
-	src = packet['src']
-	dst = packet['dst']
-	dataString = ''.join(packet['dat'])
-	methodName = None
-
-	try:
-		# First check if the src / dest is mapped in directives dict above
-		if src in directives.LIST and dst in directives.LIST[src]:
-			dstDir = directives.LIST[src][dst]
-			if ('ALL'  in dstDir.keys()):
-				methodName = dstDir['ALL']
-			elif (dataString in dstDir):
-				methodName = dstDir[dataString]
-			elif ('OTHER' in dstDir.keys()):
-				methodName = dstDir['OTHER']
-	except Exception, e:
-		logging.debug("Exception from packet manager [%s]" % e)
-		
-	result = None
-	if methodName != None:
-		methodToCall = directives.getDirectives().get(methodName, None)
-		if methodToCall:
-			logging.info("Directive found for packet - %s" % methodName)
-			try:
-				result = methodToCall(packet)
-			except:
-				logging.error("Exception raised from [%s]" % methodName)
-				logging.error(traceback.format_exc())
-		
+	methodToCall = None
+	route = DISPATCH.get((packet.src, packet.dst))
+	if route:
+		methodToCall = route.match(packet.dat)
+
+	if methodToCall:
+		pB_trace.TRACE.record(pB_trace.DISPATCH, packet, methodToCall.__name__)
+		if WORKERS:
+			# Keyed by stream so packets from one module are still handled in order, and streams on different buses don't queue behind each other
+			WORKERS.submit((packet.bus, packet.src, packet.dst), runDirective, methodToCall, packet)
 		else:
-			logging.warning("Method (%s) does not exist" % methodName)
+			return runDirective(methodToCall, packet)
 
-	return result
+# Call a directive, logging anything it raises. Anything it writes goes back to the bus the packet came from
+def runDirective(methodToCall, packet):
+	started = time.time()
+	previous = pB_buses.useBus(packet.bus)
+	try:
+		return methodToCall(packet)
+	except:
+		DIRECTIVE_ERRORS.inc(label=methodToCall.__name__)
+		logging.error("Exception raised from [%s]" % methodToCall.__name__)
+		logging.error(traceback.format_exc())
+	finally:
+		pB_buses.useBus(previous)
+		DIRECTIVE_LATENCY.observe(time.time() - started, methodToCall.__name__)
 
 # Listen for ibus messages, pass to packet manager if something substantial is found
 def listen(kwargs):
 	logging.info('Event listener initialized')
-	while True:
+	while not STOP.is_set():
 		try:
-			# Grab packet and manage appropriately
+			# Grab packet and manage appropriately. This blocks until a frame arrives or the bus goes idle,
+			# so frames are handled as fast as they come in
 			packet = WRITER.readBusPacket()
 			if packet:
 				manage(packet)
+			elif WRITER.isExhausted():
+				logging.info("Nothing left to read, event listener stopping")
+				return
 
-			time.sleep(TICK) # sleep a bit
 		except Exception, e:
 			# If an exception bubbles up this far, we've really messed up
 			print "CAUGHT OTHERWISE FATAL ERROR IN MAIN THREAD:\n{}".format(e)
+			pB_trace.TRACE.dump(names=LOCATIONS) # what the bus was doing when it happened, overwritten by the next error
+			time.sleep(ERROR_DELAY)
+
+# Have the listen loop return, it notices within one read (at most IDLE_TIMEOUT on a quiet bus)
+def stopListening():
+	STOP.set()
 
-# Handles various external messages recieved from the HTTP server
-def handleExternalMessages(message):
+# Handles various external messages recieved from the HTTP server. bus is where any writes go, the default bus if None
+def handleExternalMessages(message, bus=None):
+	previous = pB_buses.useBus(bus)
 	try:
 		# Check if we have raw data first
 		if message[0] == '[':
@@ -149,8 +200,51 @@ def handleExternalMessages(message):
 
 	except Exception, e:
 		logging.error("Failed to call directive from external command.\n{}".format(e))
+	finally:
+		pB_buses.useBus(previous)
+
+# Handles a batch of external messages in one go, in the order given. Each item is either a utility name,
+# or a raw packet as [src, dst, data] in hex, e.g. ["F0", "68", "4823"], optionally with a bus id as a fourth item.
+# bus is where everything else writes to, the default bus if None. Returns one {"ok", "result" / "error"} per item
+def handleBatch(items, bus=None):
+	results = []
+	previous = pB_buses.useBus(bus)
+	try:
+		for item in items:
+			try:
+				if isinstance(item, list):
+					if len(item) not in (3, 4) or len(item[0]) != 2 or len(item[1]) != 2 or len(item[2]) % 2:
+						raise ValueError("Raw packets look like [src, dst, data] or [src, dst, data, bus], got {}".format(item))
+					data = [item[2][i:i+2] for i in range(0, len(item[2]), 2)]
+					bytearray.fromhex(str(item[0] + item[1] + item[2])) # check it's all hex before it goes near the bus
+					if len(item) == 4:
+						sent = WRITER.writeBusPacket(str(item[0]), str(item[1]), [str(d) for d in data], bus=str(item[3]).upper())
+					else:
+						sent = WRITER.writeBusPacket(str(item[0]), str(item[1]), [str(d) for d in data])
+					results.append({"ok" : bool(sent), "result" : "OK" if sent else "Timed out"})
+				else:
+					methodToCall = utils.getUtilities().get(item, None)
+					if not callable(methodToCall):
+						raise ValueError("Utility function {} does not exist".format(item))
+					results.append({"ok" : True, "result" : methodToCall() or "OK"})
+			except Exception, e:
+				logging.warning("Batch item {} failed: {}".format(item, e))
+				results.append({"ok" : False, "error" : str(e)})
+	finally:
+		pB_buses.useBus(previous)
+	return results
 
 # Shutdown pyBus
 def shutDown():
+	global WORKERS
 	logging.info("Killing tick utility.")
-	#pB_ticker.shutDown()
\ No newline at end of file
+	#pB_ticker.shutDown()
+
+	if WORKERS:
+		logging.info("Stopping directive workers")
+		WORKERS.shutDown()
+		WORKERS = None
+
+	if SESSION:
+		logging.info("Flushing session updates")
+		SESSION.close()
\ No newline at end of file
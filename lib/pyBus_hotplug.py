@@ -0,0 +1,115 @@
+############################################################################
+# PYBUS HOTPLUG
+# NOTICES THE USB ADAPTER'S DEVICE NODE COMING AND GOING, SO THE PORT CAN BE REOPENED AS SOON AS IT'S BACK
+#
+# udev creates / removes the node (and any /dev/serial/by-id link) when the adapter is plugged in or out,
+# so watching the node's directory with inotify wakes us the moment that happens. Where inotify isn't
+# available, or the directory itself doesn't exist yet (by-id goes away with the last serial adapter),
+# the path is polled instead.
+############################################################################
+
+import os
+import time
+import errno
+import ctypes
+import select
+import logging
+
+#####################################
+# CONFIG
+#####################################
+POLL_INTERVAL = 0.1 # seconds between checks when polling
+
+# inotify flags, from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO
+
+def _libcInotify(library):
+	libc = ctypes.CDLL(library, use_errno=True)
+	libc.inotify_init1.argtypes = [ctypes.c_int]
+	libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+	return libc
+
+LIBC = None
+for library in ("libc.so.6", "libc.so"):
+	try:
+		LIBC = _libcInotify(library)
+		break
+	except (OSError, AttributeError):
+		pass
+
+#------------------------------------
+# CLASS for waiting on a device path to appear or disappear
+#------------------------------------
+class ibusDeviceWatcher ( ):
+	def __init__(self, path):
+		self.PATH = path
+		self.DIRECTORY = os.path.dirname(os.path.abspath(path))
+		self.FD = None
+		self.watching = False
+		if LIBC:
+			fd = LIBC.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+			if fd >= 0:
+				self.FD = fd
+			else:
+				logging.debug("inotify unavailable ({}), polling for {}".format(os.strerror(ctypes.get_errno()), path))
+
+	# Watch the directory if it's there, returns whether we are
+	def watch(self):
+		if self.FD is not None and not self.watching:
+			self.watching = LIBC.inotify_add_watch(self.FD, self.DIRECTORY, WATCH_MASK) >= 0
+		return self.watching
+
+	# Wait until the path exists (or doesn't, if present is False), up to timeout seconds if given.
+	# Returns whether it got there in time
+	def wait(self, present=True, timeout=None):
+		deadline = None if timeout is None else time.time() + timeout
+		while True:
+			# Watch before checking, so a change between the two isn't missed
+			watching = self.watch()
+			if os.path.exists(self.PATH) == present:
+				return True
+
+			remaining = POLL_INTERVAL if deadline is None else min(deadline - time.time(), POLL_INTERVAL)
+			if remaining <= 0:
+				return False
+			if not watching:
+				time.sleep(remaining)
+				continue
+
+			# Any event in the directory is enough to look again. Still look every POLL_INTERVAL,
+			# in case the directory itself was removed and recreated under the watch
+			try:
+				if select.select([self.FD], [], [], remaining)[0]:
+					self.drain()
+			except select.error, e:
+				if e.args[0] != errno.EINTR:
+					raise
+
+	# Throw away pending events, all that matters is that there were some
+	def drain(self):
+		try:
+			while os.read(self.FD, 4096):
+				pass
+		except OSError, e:
+			if e.errno != errno.EAGAIN:
+				raise
+
+	def close(self):
+		fd, self.FD = self.FD, None
+		if fd is not None:
+			os.close(fd)
+
+# Block until path exists, up to timeout seconds if given. Returns whether it does
+def waitForDevice(path, timeout=None):
+	watcher = ibusDeviceWatcher(path)
+	try:
+		return watcher.wait(True, timeout)
+	finally:
+		watcher.close()
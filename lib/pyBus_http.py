@@ -0,0 +1,97 @@
+############################################################################
+# PYBUS HTTP CLIENT
+# ONE SHARED, POOLED KEEP-ALIVE CLIENT FOR CALLS TO MDROID-CORE AND THE MEDIA HOST
+############################################################################
+
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+import pyBus_metrics as pB_metrics
+
+#####################################
+# CONFIG
+#####################################
+CONNECT_TIMEOUT = 2 # seconds to wait for a connection before giving up on a host
+READ_TIMEOUT = 5 # seconds to wait for a response once connected
+POOL_SIZE = 4 # keep-alive connections kept open per host
+
+class ibusHttpClient():
+
+	def __init__(self, connectTimeout=CONNECT_TIMEOUT, readTimeout=READ_TIMEOUT, poolSize=POOL_SIZE):
+		self.TIMEOUT = (connectTimeout, readTimeout)
+
+		# Connections are kept alive and reused across calls (and threads) instead of one TCP setup per request
+		self.ADAPTER = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+		self.SESSION = requests.Session()
+		self.SESSION.mount("http://", self.ADAPTER)
+		self.SESSION.mount("https://", self.ADAPTER)
+
+		self.STATS_LOCK = threading.Lock()
+		self.STATS = {
+			"requests" : 0,
+			"failures" : 0 # timeouts, refused connections etc, not HTTP error codes
+		}
+
+	def get(self, url, **kwargs):
+		return self.request("GET", url, **kwargs)
+
+	def post(self, url, **kwargs):
+		return self.request("POST", url, **kwargs)
+
+	# Same as requests.request, with our timeouts unless told otherwise
+	def request(self, method, url, **kwargs):
+		kwargs.setdefault("timeout", self.TIMEOUT)
+		with self.STATS_LOCK:
+			self.STATS["requests"] += 1
+		try:
+			return self.SESSION.request(method, url, **kwargs)
+		except requests.exceptions.RequestException:
+			with self.STATS_LOCK:
+				self.STATS["failures"] += 1
+			raise
+
+	# Request counts plus how many connections were actually opened, the rest were served by a kept-alive one
+	def getStats(self):
+		with self.STATS_LOCK:
+			stats = dict(self.STATS)
+
+		connections = 0
+		try:
+			pools = self.ADAPTER.poolmanager.pools
+			for key in pools.keys():
+				pool = pools.get(key)
+				if pool:
+					connections += pool.num_connections
+		except Exception, e:
+			logging.debug("Couldn't read connection pool stats: {}".format(e))
+
+		stats["connections"] = connections
+		stats["reused"] = max(stats["requests"] - stats["failures"] - connections, 0)
+		return stats
+
+	def close(self):
+		self.SESSION.close()
+
+# The client everything shares, replaced by configure()
+CLIENT = ibusHttpClient()
+
+# Rebuild the shared client with new settings, call before anything starts using it
+def configure(connectTimeout=CONNECT_TIMEOUT, readTimeout=READ_TIMEOUT, poolSize=POOL_SIZE):
+	global CLIENT
+	old = CLIENT
+	CLIENT = ibusHttpClient(float(connectTimeout), float(readTimeout), int(poolSize))
+	old.close()
+	return CLIENT
+
+# Expose the shared client's stats on /metrics, read from whichever client is current when scraped
+def registerMetrics():
+	for name, key, help in (
+		("http_requests_total", "requests", "HTTP requests made to MDroid-Core and the media host"),
+		("http_failures_total", "failures", "HTTP requests that timed out or couldn't connect"),
+		("http_connections_total", "connections", "HTTP connections opened"),
+		("http_reused_total", "reused", "HTTP requests served over an already open, kept-alive connection")):
+		pB_metrics.collect("pybus_" + name, help, "counter", lambda key=key: CLIENT.getStats()[key])
+
+registerMetrics()
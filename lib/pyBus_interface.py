@@ -1,4 +1,8 @@
-import serial, time, logging, threading
+import serial, time, logging, threading, select, errno, Queue
+import pyBus_capture as pB_capture
+import pyBus_hotplug as pB_hotplug
+import pyBus_metrics as pB_metrics
+import pyBus_trace as pB_trace
 
 # LOCATIONS, a mapping of hex codes seen in SRC/DST parts of packets. This WILL change across models/years.
 LOCATIONS = {
@@ -68,31 +72,289 @@ LOCATIONS = {
 	'100' : 'Unset',
 	'101' : 'Unknown'
 }
+
+RING_SIZE = 4096 # bytes kept between reads in buffered mode, must be a power of two
+MAX_DATA_LEN = 20 # no useful packet carries more data bytes than this
+IDLE_TIMEOUT = 0.5 # seconds a buffered read waits on a quiet bus before giving up
+TX_TIMEOUT = 5 # seconds writeBusPacket waits for its packet to actually go out
+TX_HOLD = TX_TIMEOUT # seconds a queued packet is held for while the adapter is unplugged, before it's dropped
+RECONNECT_RETRY = 0.05 # seconds between attempts to open a port whose device node is back but not ready yet
+
+# What the port raises once the adapter has gone away
+PORT_ERRORS = (serial.SerialException, OSError, IOError)
+# Older pyserial raises ValueError for a port that's been closed, which only counts as the adapter going away if
+# the port really is closed (see ibusFace.isPortError). Any other ValueError is a bug, and is left to surface
+CLOSED_PORT_ERRORS = PORT_ERRORS + (ValueError,)
+BYTE_TIME = 11.0 / 9600 # seconds one byte takes on the wire, 8 data bits plus start, parity and stop at 9600 baud
+BUS_IDLE_GAP = 2 * BYTE_TIME # quiet time needed on the bus before a new frame may start
+
+TX_WAIT = pB_metrics.histogram("pybus_tx_wait_seconds", "Time frames spent queued and waiting for a clear bus before going out", "bus")
+
+OPEN_FACES = dict() # bus id : open ibusFace, what /metrics reports on
+
+#------------------------------------
+# CLASS for buffering raw bytes read from the bus
+# Fixed size and reused for the life of the interface, so reading doesn't allocate per byte
+#------------------------------------
+class ibusRingBuffer ( ):
+	def __init__(self, size=RING_SIZE):
+		self.BUF = bytearray(size)
+		self.MASK = size - 1
+		self.head = 0 # absolute position of the oldest unread byte
+		self.tail = 0 # absolute position one past the newest byte
+
+	def __len__(self):
+		return self.tail - self.head
+
+	def free(self):
+		return self.MASK + 1 - len(self)
+
+	# Append raw data read from the port, dropping the oldest bytes if we've fallen that far behind
+	def write(self, data):
+		size = len(data)
+		capacity = self.MASK + 1
+		if size > capacity:
+			data = data[-capacity:]
+			size = capacity
+		overflow = len(self) + size - capacity
+		if overflow > 0:
+			logging.warning("Ring buffer overflow, dropping %d unread bytes" % overflow)
+			self.head += overflow
+
+		start = self.tail & self.MASK
+		first = min(size, capacity - start)
+		self.BUF[start:start + first] = data[:first]
+		if first < size:
+			self.BUF[0:size - first] = data[first:]
+		self.tail += size
+
+	# Look at a byte without consuming it, offset is relative to the oldest unread byte
+	def peek(self, offset):
+		return self.BUF[(self.head + offset) & self.MASK]
+
+	# Copy out a run of bytes without consuming them
+	def copy(self, offset, length):
+		start = (self.head + offset) & self.MASK
+		end = start + length
+		if end <= self.MASK + 1:
+			return self.BUF[start:end]
+		return self.BUF[start:] + self.BUF[:end - self.MASK - 1]
+
+	def consume(self, count):
+		self.head += min(count, len(self))
+
+	def clear(self):
+		self.head = self.tail
+
+# XOR of every byte given. Over a whole frame (checksum included) this is 0 when the frame is intact
+def xorChecksum(data):
+	chk = 0
+	for b in data:
+		chk ^= b
+	return chk
+
+#------------------------------------
+# CLASS for assembling frames out of the ring buffer
+# Packets look like [SRC, LEN, DST, DATA..., XOR], where LEN counts everything after itself.
+# Bytes are only consumed once a whole, checksum-valid frame is available, so it can be fed any chunking of the stream.
+# A bad length or checksum slides the window forward by one byte and tries again from there,
+# rather than throwing away everything until the bus goes quiet.
+#------------------------------------
+class ibusFrameParser ( ):
+	STATE_SRC = 0
+	STATE_LEN = 1
+	STATE_BODY = 2
+
+	def __init__(self, ring):
+		self.RING = ring
+		self.state = self.STATE_SRC
+		self.frameLen = 0
+		self.resyncing = False
+		self.STATS = {
+			"frames" : 0, # valid frames parsed
+			"bad_length" : 0, # frame starts with an impossible length byte
+			"bad_checksum" : 0, # complete frames failing the XOR check
+			"stale" : 0, # partial frames left hanging when the bus went idle
+			"resyncs" : 0, # times we found our way back to a valid frame after sliding
+			"skipped_bytes" : 0 # bytes discarded while resyncing
+		}
+
+	# Returns the next complete frame as a bytearray, or None if more bytes are needed.
+	# idle means the bus has gone quiet, so a partial frame still waiting for bytes never will get them
+	def parse(self, idle=False):
+		ring = self.RING
+		while True:
+			available = len(ring)
+			if self.state == self.STATE_SRC:
+				if available < 1:
+					return None
+				self.state = self.STATE_LEN
+
+			elif self.state == self.STATE_LEN:
+				if available < 2:
+					if idle:
+						self.slide("stale")
+						continue
+					return None
+				length = ring.peek(1)
+				if length < 2 or length - 2 > MAX_DATA_LEN:
+					pB_trace.TRACE.record(pB_trace.BAD_LENGTH, None, length)
+					self.slide("bad_length")
+					continue
+				self.frameLen = length + 2
+				self.state = self.STATE_BODY
+
+			else:
+				if available < self.frameLen:
+					if idle:
+						self.slide("stale")
+						continue
+					return None
+				frame = ring.copy(0, self.frameLen)
+				if xorChecksum(frame):
+					pB_trace.TRACE.record(pB_trace.BAD_CHECKSUM, frame)
+					self.slide("bad_checksum")
+					continue
+				ring.consume(self.frameLen)
+				self.state = self.STATE_SRC
+				self.STATS["frames"] += 1
+				if self.resyncing:
+					self.STATS["resyncs"] += 1
+					self.resyncing = False
+				return frame
+
+	# Give up on the frame starting at the head and try again from the next byte
+	def slide(self, reason):
+		self.STATS[reason] += 1
+		self.STATS["skipped_bytes"] += 1
+		self.RING.consume(1)
+		self.state = self.STATE_SRC
+		self.resyncing = True
+
+	def reset(self):
+		self.RING.clear()
+		self.state = self.STATE_SRC
+		self.resyncing = False
+
+#------------------------------------
+# CLASS for a single packet read from the bus
+# Addresses, length and checksum are ints and the data is a bytearray, hex strings are only built on request.
+# bus is the id of the ibusFace it was read from
+#------------------------------------
+class ibusPacket ( object ):
+	__slots__ = ('src', 'len', 'dst', 'dat', 'xor', 'bus', '_datHex')
+
+	def __init__(self, src, length, dst, dat, xor, bus=None):
+		self.src = src
+		self.len = length
+		self.dst = dst
+		self.dat = dat
+		self.xor = xor
+		self.bus = bus
+		self._datHex = None
+
+	# Build a packet from a complete raw frame, [SRC, LEN, DST, DATA..., XOR]
+	@classmethod
+	def fromFrame(cls, frame, bus=None):
+		return cls(frame[0], frame[1], frame[2], frame[3:-1], frame[-1], bus)
+
+	def srcHex(self):
+		return '%02X' % self.src
+
+	def dstHex(self):
+		return '%02X' % self.dst
+
+	# Data as one hex string, e.g. '3B01'. Cached since matching and logging both want it
+	def datHex(self):
+		if self._datHex is None:
+			self._datHex = ('%02X' * len(self.dat)) % tuple(self.dat)
+		return self._datHex
+
+	# A single data byte as hex, negative indexes count from the end like a list
+	def byteHex(self, index):
+		return '%02X' % self.dat[index]
+
+	# The raw frame, checksum included
+	def toBytes(self):
+		return bytes(bytearray([self.src, self.len, self.dst]) + self.dat + bytearray([self.xor]))
+
+	# Old dict-style access (packet['dat'] etc.) for directives that still expect hex strings
+	def __getitem__(self, key):
+		if key == 'dat':
+			return ['%02X' % b for b in self.dat]
+		if key in ('src', 'len', 'dst', 'xor'):
+			return '%02X' % getattr(self, key)
+		raise KeyError(key)
+
+	def __repr__(self):
+		return "%s" % [self.srcHex(), '%02X' % self.len, self.dstHex(), self['dat'], '%02X' % self.xor]
+
+#------------------------------------
+# CLASS for a packet waiting on the transmit thread
+# If it can't go out by its deadline (i.e. the adapter stays unplugged), it's dropped
+#------------------------------------
+class ibusTxRequest ( object ):
+	__slots__ = ('frame', 'done', 'sent', 'queued', 'deadline')
+
+	def __init__(self, frame, hold=TX_HOLD):
+		self.frame = frame
+		self.done = threading.Event()
+		self.sent = False
+		self.queued = time.time()
+		self.deadline = self.queued + hold
+
 #------------------------------------
 # CLASS for iBus communications
 #------------------------------------
 class ibusFace ( ):
 	# Initialize the serial connection - then use some commands I saw somewhere once
-	def __init__(self, devPath,):
-		self.SDEV = serial.Serial(
-			devPath,
-			baudrate=9600,
-			bytesize=serial.EIGHTBITS,
-			parity=serial.PARITY_EVEN,
-			stopbits=serial.STOPBITS_ONE,
-			timeout=0.5
-		)
-		self.SDEV.setDTR(True)
-		self.SDEV.flushInput()
-		self.SDEV.lastWrite = int(round(time.time() * 1000))
+	# buffered reads everything pending on the port at once and parses frames from a ring buffer,
+	# otherwise packets are assembled one readChar() at a time.
+	# device stands in for the serial port if given, e.g. a pyBus_replay.replaySerial
+	# bus names this interface (e.g. IBUS / KBUS) on its packets and metrics, the device path if not given
+	# txHold is how long writes are held for while the adapter is unplugged
+	def __init__(self, devPath, buffered=True, device=None, bus=None, txHold=TX_HOLD):
+		self.DEVPATH = devPath
+		self.BUS = bus or devPath
+		self.TX_HOLD = txHold
+		self.REOPEN = device is None # a stand-in device can't be unplugged and reopened
+		self.SDEV = device or self.openPort()
+		self.ONLINE = threading.Event() # cleared while the adapter is unplugged
+		self.ONLINE.set()
+		self.PORT_LOCK = threading.Lock()
+		self.closing = False
+		self.lastRxTime = 0 # when we last saw a byte on the bus
+		self.lastTxTime = 0 # when our last write finished leaving the port
 		self.PACKET_STACK = []
-		self.LOCKED = False
+		self.BUFFERED = buffered
+		self.RING = ibusRingBuffer()
+		self.PARSER = ibusFrameParser(self.RING)
+		self.STATS = self.PARSER.STATS # shared so both read modes count into the same place
+		self.STATS.update({
+			"bytes_read" : 0,
+			"bytes_written" : 0,
+			"frames_written" : 0,
+			"clear_bus_waits" : 0, # waitClearBus calls, i.e. times we lost our place on the bus
+			"disconnects" : 0, # times the adapter went away
+			"reconnects" : 0, # times it came back
+			"tx_expired" : 0 # writes dropped because the adapter stayed away past their deadline
+		})
+		self.CAPTURE = None # records every frame read when capturing, see startCapture()
+
+		# Writes are handed to a single transmit thread, so readers never wait on writers (or each other)
+		self.TX_QUEUE = Queue.Queue()
+		self.TX_THREAD = threading.Thread(target=self.transmitLoop, name="ibusTransmit")
+		self.TX_THREAD.daemon = True
+		self.TX_THREAD.start()
+		OPEN_FACES[self.BUS] = self
+		registerMetrics()
 		logging.debug("Initialized iBus")
 
 	# Wait for a significant delay in the bus before parsing stuff (signals separated by pauses)
 	def waitClearBus(self):
 		logging.debug("Waiting for clear bus")
-		self.LOCKED = self.getLock(threading.current_thread().name, "waitClearBus")
+		self.STATS["clear_bus_waits"] += 1
+		self.PARSER.reset() # anything buffered so far is being thrown away along with the bus traffic
 		oldTime = time.time()
 		while True:
 			# Wait for large interval between packets
@@ -103,7 +365,6 @@ class ibusFace ( ):
 			if deltaTime > 0.1:
 				# If srcPacket is none, the serial read timed out, meaning the bus is both quiet and clear
 				if not srcPacket:
-					self.LOCKED = False
 					return
 
 				break # we have found a significant delay in signals, but have swallowed the first character in doing so.
@@ -116,66 +377,243 @@ class ibusFace ( ):
 			self.readChar()
 			dataLen = dataLen - 1
 		self.readChar() # XOR packet. This will be the last bit of the packet. I could change the while loop variable by one, but this adds clarity.
-		self.LOCKED = False
 
-	# Read a packet from the bus
+	# Open the serial port, setting it up the way the interface expects
+	def openPort(self):
+		port = serial.Serial(
+			self.DEVPATH,
+			baudrate=9600,
+			bytesize=serial.EIGHTBITS,
+			parity=serial.PARITY_EVEN,
+			stopbits=serial.STOPBITS_ONE,
+			timeout=0.5
+		)
+		port.setDTR(True)
+		port.flushInput()
+		return port
+
+	# Whether the port is open, i.e. the adapter is plugged in
+	def isOnline(self):
+		return self.ONLINE.is_set()
+
+	# Called from whichever thread noticed the adapter go away. Closes the port and reopens it in the background
+	# as soon as the device is back. Everything else (ring buffer, parser, TX queue, stats, capture) carries on as it was
+	def portLost(self, error):
+		with self.PORT_LOCK:
+			if not self.ONLINE.is_set():
+				return
+			self.ONLINE.clear()
+			self.STATS["disconnects"] += 1
+			try:
+				self.SDEV.close()
+			except Exception:
+				pass
+
+		pB_trace.TRACE.record(pB_trace.PORT_LOST, None, error)
+		if not self.REOPEN or self.closing:
+			logging.error("Lost %s (%s)" % (self.BUS, error))
+			return
+		logging.warning("Lost %s (%s), reconnecting once %s is back" % (self.BUS, error, self.DEVPATH))
+		reconnect = threading.Thread(target=self.reconnectLoop, name="ibusReconnect-%s" % self.BUS)
+		reconnect.daemon = True
+		reconnect.start()
+
+	# Reopen the port once its device node is back. udev can take a moment to make a new node usable, so opening is retried
+	def reconnectLoop(self):
+		lost = time.time()
+		watcher = pB_hotplug.ibusDeviceWatcher(self.DEVPATH)
+		try:
+			while not self.closing:
+				if not watcher.wait(True, TX_TIMEOUT):
+					continue
+				try:
+					port = self.openPort()
+				except PORT_ERRORS, e:
+					logging.debug("%s not ready yet: %s" % (self.DEVPATH, e))
+					time.sleep(RECONNECT_RETRY)
+					continue
+
+				with self.PORT_LOCK:
+					self.SDEV = port
+					self.lastRxTime = time.time() # let the bus settle before writing
+					self.STATS["reconnects"] += 1
+					self.ONLINE.set()
+				pB_trace.TRACE.record(pB_trace.PORT_BACK, None, self.DEVPATH)
+				logging.info("Reconnected %s after %.2fs" % (self.BUS, time.time() - lost))
+				return
+		finally:
+			watcher.close()
+
+	# Read a packet from the bus, None while the adapter is unplugged
 	def readBusPacket(self):
-		self.LOCKED = self.getLock(threading.current_thread().name, "readBusPacket")
-
-		packet = {
-			"src" : None,
-			"len" : None,
-			"dst" : None,
-			"dat" : [],
-			"xor" : None
-		}
-		packet["src"] = self.readChar()
+		if not self.ONLINE.is_set():
+			self.ONLINE.wait(IDLE_TIMEOUT)
+			return None
+
+		try:
+			if self.BUFFERED:
+				return self.readBufferedPacket()
+			return self.readUnbufferedPacket()
+		except CLOSED_PORT_ERRORS, e:
+			if not self.isPortError(e):
+				raise
+			self.portLost(e)
+			return None
+
+	# Read a packet one readChar() at a time
+	def readUnbufferedPacket(self):
+		src = self.readChar()
 
 		# If these are none, chances are we timed out
 		# Regardless, the packet is not useful
-		if not packet["src"]:
-			self.LOCKED = False
+		if not src:
 			return None
 
-		packet["len"] = self.readChar()
-		packet["dst"] = self.readChar()
+		length = self.readChar()
+		dst = self.readChar()
 
-		if not packet["len"] or not packet["dst"]:
-			self.LOCKED = False
+		if not length or not dst:
 			return None
 
-		dataLen = int(packet['len'], 16) - 2
-		if dataLen > 20:
+		dataLen = int(length, 16) - 2
+		if dataLen > MAX_DATA_LEN:
 			logging.critical("Length of +20 found, no useful packet is this long.. cleaning up")
-			self.LOCKED = False
+			self.STATS["bad_length"] += 1
 			self.waitClearBus()
 			return None
 
-		dataTmp = []
+		dataTmp = bytearray()
 		while dataLen > 0:
-			dataTmp.append(self.readChar())
+			char = self.readChar()
+			if not char: # timed out part way through the packet
+				return None
+			dataTmp.append(int(char, 16))
 			dataLen = dataLen - 1
-		packet['dat'] = dataTmp
-		packet['xor'] = self.readChar()
-		valStr = [packet['src'], packet['len'], packet['dst'], packet['dat'], packet['xor']]
-		self.LOCKED = False
+		xor = self.readChar()
 
-		if packet['dat']:
-			srcLocation = LOCATIONS[packet["src"]] if packet["src"] in LOCATIONS else packet["src"]
-			dstLocation = LOCATIONS[packet["dst"]] if packet["dst"] in LOCATIONS else packet["dst"]
+		if not xor:
+			return None
 
-			logging.debug("READ: [%s -> %s] %s" % (srcLocation, dstLocation, valStr))
+		packet = ibusPacket(int(src, 16), int(length, 16), int(dst, 16), dataTmp, int(xor, 16), self.BUS)
+		if xorChecksum(bytearray(packet.toBytes())):
+			pB_trace.TRACE.record(pB_trace.BAD_CHECKSUM, packet)
+			self.STATS["bad_checksum"] += 1
+			return None
+		self.STATS["frames"] += 1
+
+		if self.CAPTURE:
+			self.captureFrame(packet.toBytes())
+		return self.checkPacket(packet)
+
+	# Read a packet out of the ring buffer, topping it up from the port when no complete frame is waiting
+	def readBufferedPacket(self):
+		while True:
+			packet = self.parsePacket()
+			if packet:
+				return packet
+			if not self.fillBuffer():
+				# nothing arrived before the timeout, bus is quiet. Whatever is left can't be completed,
+				# so look for a valid frame inside it before giving up
+				return self.parsePacket(idle=True)
+
+	# Next packet out of what's already in the ring buffer, without touching the port. None if no complete frame is waiting
+	def parsePacket(self, idle=False):
+		while True:
+			frame = self.PARSER.parse(idle)
+			if frame is None:
+				return None
+			if self.CAPTURE:
+				self.captureFrame(frame)
+			packet = self.checkPacket(ibusPacket.fromFrame(frame, self.BUS))
+			if packet:
+				return packet
+
+	# Trace a freshly read packet, dropping it if it carries no data
+	def checkPacket(self, packet):
+		if packet.dat:
+			pB_trace.TRACE.record(pB_trace.READ, packet, self.BUS)
+			if logging.getLogger().isEnabledFor(logging.DEBUG):
+				srcLocation = LOCATIONS.get(packet.srcHex(), packet.srcHex())
+				dstLocation = LOCATIONS.get(packet.dstHex(), packet.dstHex())
+				logging.debug("READ: [%s -> %s] %s" % (srcLocation, dstLocation, packet))
 			return packet
 		else:
-			logging.debug("Empty packet! Got: %s" % (valStr))
+			logging.debug("Empty packet! Got: %s", packet)
 			return None
 
+	# Pull everything pending on the port (up to the free space in the ring) into the ring buffer with a single read.
+	# If nothing is waiting, sleeps until the port has data or IDLE_TIMEOUT passes. Returns the number of bytes read
+	def fillBuffer(self, timeout=None):
+		if not self.pendingBytes() and not self.waitForData(IDLE_TIMEOUT if timeout is None else timeout):
+			return 0
+
+		size = min(max(self.pendingBytes(), 1), self.RING.free())
+		data = self.SDEV.read(size)
+
+		if data:
+			self.lastRxTime = time.time()
+			self.STATS["bytes_read"] += len(data)
+			self.RING.write(data)
+		return len(data)
+
+	# Block until the port is readable
+	def waitForData(self, timeout):
+		try:
+			fd = self.SDEV.fileno()
+		except (AttributeError, ValueError, IOError):
+			return True # can't select on this port, fall back to the blocking read and its own timeout
+
+		try:
+			readable, _, _ = select.select([fd], [], [], timeout)
+		except select.error, e:
+			if e.args[0] == errno.EINTR:
+				return False
+			raise
+		return bool(readable)
+
+	# fillBuffer for readers juggling several ports (see pyBus_buses), returns 0 if the adapter has gone away
+	def refill(self, timeout=None):
+		try:
+			return self.fillBuffer(timeout)
+		except CLOSED_PORT_ERRORS, e:
+			if not self.isPortError(e):
+				raise
+			self.portLost(e)
+			return 0
+
+	# pendingBytes, 0 if the adapter has gone away
+	def waitingBytes(self):
+		try:
+			return self.pendingBytes()
+		except CLOSED_PORT_ERRORS, e:
+			if not self.isPortError(e):
+				raise
+			self.portLost(e)
+			return 0
+
+	# Whether e (one of CLOSED_PORT_ERRORS) means the adapter has gone away, rather than a bug in reading what it sent
+	def isPortError(self, e):
+		if not isinstance(e, ValueError):
+			return True
+		try:
+			return not (self.SDEV.is_open if hasattr(self.SDEV, 'is_open') else self.SDEV.isOpen())
+		except Exception:
+			return False
+
+	# Number of bytes the port has waiting, across pyserial versions
+	def pendingBytes(self):
+		if hasattr(self.SDEV, 'in_waiting'):
+			return self.SDEV.in_waiting
+		return self.SDEV.inWaiting()
+
 	# Read in one character from the bus and convert to hex
 	def readChar(self):
 		char = self.SDEV.read(1)
 
 		# char is empty, that means the read timed out
 		if char:
+			self.lastRxTime = time.time()
+			self.STATS["bytes_read"] += 1
 			try:
 				char = '%02X' % ord(char)
 			except serial.SerialException, e: 
@@ -183,13 +621,11 @@ class ibusFace ( ):
 				pass
 		return char
 
-	# Write a string of data created from complete contents of packet
+	# Write a string of data created from complete contents of packet.
+	# Only the transmit thread calls this, so it is the only writer on the port
 	def writeFullPacket(self, packet):
-		self.LOCKED = self.getLock(threading.current_thread().name, "writeFullPacket")
-		data = ''.join(chr(p) for p in packet)
-		self.SDEV.write(data)
+		self.SDEV.write(bytes(packet))
 		self.SDEV.flush()
-		self.LOCKED = False
 
 	# get the checksum of a complete packet to be appended to the packet - I think everything listening on ibus checks these packets (except for this tool)
 	def getCheckSum(self, packet):
@@ -200,20 +636,19 @@ class ibusFace ( ):
 		return chk
 
 	# Write Packet to iBus, first length is determined, the packet is then constructed and a checksum generated/appended.
-	# The packet is then sent if the CTS signal is good (Clear To Send)
+	# The packet is then queued for the transmit thread, which sends it when the CTS signal is good (Clear To Send).
+	# By default this waits until the packet has gone out (or TX_TIMEOUT passes) and returns whether it was sent,
+	# pass wait=False to just queue it.
 	# TODO: Read to verify the packet we send is seen
-	def writeBusPacket(self, src, dst, data):
-		time.sleep(0.01) # pause a tick
-
+	def writeBusPacket(self, src, dst, data, wait=True):
 		# Check if system is woken up
-		#if (int(round(time.time() * 1000)) - self.SDEV.lastWrite > 1000:
+		#if time.time() - self.lastTxTime > 1:
 		#	self.writeBusPacket(self, '44', '80', '16') # request odometer to wake devices up
 
 		length = '%02X' % (2 + len(data))
 		packet = [src, length, dst]
 		for p in data:
 			packet.append(p)
-		logging.debug("WRITE: Adding to stack: %s" % packet)
 		for i in range(len(packet)):
 			packet[i] = int('0x%s' % packet[i], 16)
 
@@ -221,29 +656,129 @@ class ibusFace ( ):
 		lastInd=len(packet) - 1
 		packet[lastInd] = chk # packet is an array of int
 
-		packetSent = False
-		while (not packetSent):
-			logging.debug("WRITE: %s" % packet)
-			if (self.SDEV.getCTS()) and ((int(round(time.time() * 1000)) - self.SDEV.lastWrite) > 10): # dont write packets to close together.. issues arise
-				self.writeFullPacket(packet)
-				logging.debug("WRITE: SUCCESS")
-				self.SDEV.lastWrite = int(round(time.time() * 1000))
-				packetSent = True
+		request = ibusTxRequest(bytearray(packet), self.TX_HOLD)
+		pB_trace.TRACE.record(pB_trace.WRITE_QUEUED, request.frame)
+		self.TX_QUEUE.put(request)
+		if not wait:
+			return True
+
+		if not request.done.wait(max(TX_TIMEOUT, self.TX_HOLD)):
+			logging.warning("WRITE: Timed out waiting to send %s" % packet)
+		return request.sent
+
+	# Transmit thread, owns all writes to the port. Packets go out one at a time in the order they were queued,
+	# so a run of queued packets is sent back to back with only the minimum gap between them.
+	# While the adapter is unplugged packets are held, and sent once it's back unless their deadline has passed
+	def transmitLoop(self):
+		while True:
+			request = self.TX_QUEUE.get()
+			if request is None:
+				return
+
+			try:
+				while True:
+					if not self.ONLINE.wait(max(request.deadline - time.time(), 0)):
+						self.STATS["tx_expired"] += 1
+						pB_trace.TRACE.record(pB_trace.WRITE_FAILED, request.frame, "adapter unplugged past the deadline")
+						logging.warning("WRITE: Dropped %s, %s still unplugged" % (['%02X' % b for b in request.frame], self.BUS))
+						break
+					try:
+						self.transmit(request.frame)
+					except CLOSED_PORT_ERRORS, e:
+						if not self.isPortError(e):
+							raise
+						self.portLost(e) # held until it's back
+						continue
+					request.sent = True
+					TX_WAIT.observe(self.lastTxTime - request.queued, self.BUS)
+					pB_trace.TRACE.record(pB_trace.WRITE, request.frame, self.lastTxTime - request.queued)
+					break
+			except Exception, e:
+				pB_trace.TRACE.record(pB_trace.WRITE_FAILED, request.frame, e)
+				logging.error("WRITE: Failed to send %s: %s" % (['%02X' % b for b in request.frame], e))
+			finally:
+				request.done.set()
+
+	# Send one frame at the earliest safe moment: once nothing has been seen on the bus (including our own
+	# last write) for BUS_IDLE_GAP, and the adapter is holding CTS up
+	def transmit(self, frame):
+		while True:
+			wait = max(self.lastRxTime, self.lastTxTime) + BUS_IDLE_GAP - time.time()
+			if wait > 0:
+				time.sleep(wait)
+			elif not self.SDEV.getCTS():
+				pB_trace.TRACE.record(pB_trace.WRITE_BUSY, frame)
+				time.sleep(BYTE_TIME) # adapter says the bus is busy, check again after a byte's worth of time
 			else:
-				logging.debug("WRITE: WAIT")
-				time.sleep(0.01)
+				break
+
+		self.writeFullPacket(frame) # returns once the frame has left the port
+		self.lastTxTime = time.time()
+		self.STATS["frames_written"] += 1
+		self.STATS["bytes_written"] += len(frame)
 
-	def getLock(self, thread, reason):
-		TIME_TO_SLEEP = 0.02
+	# Record every frame read from here on into rotating binary capture files in directory
+	def startCapture(self, directory, maxBytes=pB_capture.MAX_BYTES, maxFiles=pB_capture.MAX_FILES):
+		self.stopCapture()
+		self.CAPTURE = pB_capture.ibusCaptureWriter(directory, int(maxBytes), int(maxFiles))
 
-		waits = 0
-		while(self.LOCKED):
-			waits += 1
-			if not waits % 10: 
-				logging.debug("{}: waiting for lock. Locked by {} at {}".format(reason, self.LOCKED[1], self.LOCKED[0]))
-			time.sleep(TIME_TO_SLEEP)
-		return [thread, reason]
+	def stopCapture(self):
+		capture, self.CAPTURE = self.CAPTURE, None
+		if capture:
+			capture.close()
+
+	def captureFrame(self, frame):
+		try:
+			self.CAPTURE.record(frame)
+		except (IOError, OSError), e:
+			logging.error("Failed to capture frame, stopping capture: %s" % e)
+			self.stopCapture()
+
+	# Whether the port has run dry for good, which only happens when replaying a recording
+	def isExhausted(self):
+		exhausted = getattr(self.SDEV, "exhausted", None)
+		return bool(exhausted and exhausted() and not len(self.RING))
+
+	# Copy of the frame counters, i.e. how many frames were read and how many were corrupt or resynced
+	def getStats(self):
+		return dict(self.STATS)
 
 	def close(self):
-		self.SDEV.close()
+		self.closing = True
+		if OPEN_FACES.get(self.BUS) is self:
+			del OPEN_FACES[self.BUS]
+		self.stopCapture()
+		self.TX_QUEUE.put(None)
+		self.TX_THREAD.join(TX_TIMEOUT)
+		with self.PORT_LOCK:
+			self.ONLINE.clear()
+			self.SDEV.close()
 #---------- END CLASS -------------
+
+# {bus id : func(face)} over every open interface
+def perBus(func):
+	return dict((bus, func(face)) for bus, face in OPEN_FACES.items())
+
+# Expose each open interface's STATS on /metrics, labelled by bus. These are read when scraped, so the read path doesn't pay anything extra
+def registerMetrics():
+	for name, key, help in (
+		("frames_read", "frames", "Valid frames read from the bus"),
+		("frames_written", "frames_written", "Frames written to the bus"),
+		("bytes_read", "bytes_read", "Bytes read from the bus"),
+		("bytes_written", "bytes_written", "Bytes written to the bus"),
+		("checksum_errors", "bad_checksum", "Frames dropped for failing the XOR check"),
+		("bad_lengths", "bad_length", "Impossible length bytes skipped while resyncing"),
+		("stale_frames", "stale", "Partial frames dropped when the bus went idle"),
+		("resyncs", "resyncs", "Times a valid frame was found again after losing our place"),
+		("skipped_bytes", "skipped_bytes", "Bytes discarded while resyncing"),
+		("clear_bus_waits", "clear_bus_waits", "Calls to waitClearBus"),
+		("disconnects", "disconnects", "Times the adapter went away"),
+		("reconnects", "reconnects", "Times the adapter came back and its port was reopened"),
+		("tx_expired", "tx_expired", "Frames dropped because the adapter stayed unplugged past their deadline")):
+		pB_metrics.collect("pybus_%s_total" % name, help, "counter", lambda key=key: perBus(lambda face: face.STATS[key]), "bus")
+
+	# Bytes per second and utilisation are rate() of the bytes and busy seconds totals, so any number of scrapers agree
+	pB_metrics.collect("pybus_bus_busy_seconds_total", "Seconds the bus spent carrying bytes we read or wrote", "counter",
+		lambda: perBus(lambda face: (face.STATS["bytes_read"] + face.STATS["bytes_written"]) * BYTE_TIME), "bus")
+	pB_metrics.collect("pybus_tx_queue_depth", "Frames waiting on the transmit thread", "gauge", lambda: perBus(lambda face: face.TX_QUEUE.qsize()), "bus")
+	pB_metrics.collect("pybus_ring_buffer_bytes", "Bytes read but not yet parsed", "gauge", lambda: perBus(lambda face: len(face.RING)), "bus")
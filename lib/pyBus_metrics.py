@@ -0,0 +1,154 @@
+############################################################################
+# PYBUS METRICS
+# IN-PROCESS COUNTERS AND HISTOGRAMS, RENDERED IN PROMETHEUS TEXT FORMAT FOR /metrics
+#
+# Counts the hot path already keeps (ibusFace.STATS, queue sizes) aren't duplicated here,
+# they're registered as collectors and only read when /metrics is scraped. Everything is a running total or a
+# current value, nothing depends on when it was last scraped: per second rates are left to PromQL's rate().
+############################################################################
+
+import bisect
+import threading
+
+#####################################
+# CONFIG
+#####################################
+# Upper bounds in seconds, from a few microseconds (a decoder) to seconds (a slow upload)
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+REGISTRY = dict() # name : metric
+REGISTRY_LOCK = threading.Lock()
+
+def formatValue(value):
+	if value == float("inf"):
+		return "+Inf"
+	if isinstance(value, float):
+		return repr(value)
+	return str(value)
+
+def formatLabels(labels):
+	if not labels:
+		return ""
+	return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in labels) + "}"
+
+#------------------------------------
+# CLASS for a counter, optionally split by one label
+#------------------------------------
+class ibusCounter ( ):
+	KIND = "counter"
+
+	def __init__(self, name, help, label=None):
+		self.NAME = name
+		self.HELP = help
+		self.LABEL = label
+		self.LOCK = threading.Lock()
+		self.values = dict() # label value (None if unlabelled) : count
+
+	def inc(self, amount=1, label=None):
+		with self.LOCK:
+			self.values[label] = self.values.get(label, 0) + amount
+
+	def samples(self):
+		with self.LOCK:
+			values = dict(self.values)
+		if not values and not self.LABEL:
+			values[None] = 0
+		for label, value in sorted(values.items()):
+			yield self.NAME, [(self.LABEL, label)] if self.LABEL else [], value
+
+#------------------------------------
+# CLASS for a histogram of durations (or anything else), optionally split by one label
+#------------------------------------
+class ibusHistogram ( ):
+	KIND = "histogram"
+
+	def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+		self.NAME = name
+		self.HELP = help
+		self.LABEL = label
+		self.BUCKETS = tuple(sorted(buckets))
+		self.LOCK = threading.Lock()
+		self.values = dict() # label value : [per bucket counts (plus +Inf), sum]
+
+	def observe(self, value, label=None):
+		index = bisect.bisect_left(self.BUCKETS, value)
+		with self.LOCK:
+			entry = self.values.get(label)
+			if entry is None:
+				entry = self.values[label] = [[0] * (len(self.BUCKETS) + 1), 0.0]
+			entry[0][index] += 1
+			entry[1] += value
+
+	def samples(self):
+		with self.LOCK:
+			values = dict((label, (list(counts), total)) for label, (counts, total) in self.values.items())
+		for label, (counts, total) in sorted(values.items()):
+			labels = [(self.LABEL, label)] if self.LABEL else []
+			cumulative = 0
+			for bound, count in zip(self.BUCKETS + (float("inf"),), counts):
+				cumulative += count
+				yield self.NAME + "_bucket", labels + [("le", formatValue(float(bound)))], cumulative
+			yield self.NAME + "_sum", labels, total
+			yield self.NAME + "_count", labels, cumulative
+
+#------------------------------------
+# CLASS for a value read from elsewhere at scrape time. func returns a number, or {label value : number}
+#------------------------------------
+class ibusCollector ( ):
+	def __init__(self, name, help, kind, func, label=None):
+		self.NAME = name
+		self.HELP = help
+		self.KIND = kind
+		self.FUNC = func
+		self.LABEL = label
+
+	def samples(self):
+		value = self.FUNC()
+		if isinstance(value, dict):
+			for label, number in sorted(value.items()):
+				yield self.NAME, [(self.LABEL, label)], number
+		elif value is not None:
+			yield self.NAME, [], value
+
+#####################################
+# REGISTRATION
+# Registering a name again replaces the old metric, e.g. when the interface is reopened
+#####################################
+def register(metric):
+	with REGISTRY_LOCK:
+		REGISTRY[metric.NAME] = metric
+	return metric
+
+# Counters and histograms are looked up first, so every module asking for one gets the same instance
+def counter(name, help, label=None):
+	with REGISTRY_LOCK:
+		if name not in REGISTRY:
+			REGISTRY[name] = ibusCounter(name, help, label)
+		return REGISTRY[name]
+
+def histogram(name, help, label=None, buckets=LATENCY_BUCKETS):
+	with REGISTRY_LOCK:
+		if name not in REGISTRY:
+			REGISTRY[name] = ibusHistogram(name, help, label, buckets)
+		return REGISTRY[name]
+
+def collect(name, help, kind, func, label=None):
+	return register(ibusCollector(name, help, kind, func, label))
+
+# Everything registered, in the Prometheus text exposition format
+def render():
+	with REGISTRY_LOCK:
+		metrics = sorted(REGISTRY.items())
+
+	lines = []
+	for name, metric in metrics:
+		try:
+			samples = list(metric.samples())
+		except Exception, e:
+			lines.append("# {} unavailable: {}".format(name, e))
+			continue
+		lines.append("# HELP {} {}".format(name, metric.HELP))
+		lines.append("# TYPE {} {}".format(name, metric.KIND))
+		for sampleName, labels, value in samples:
+			lines.append("{}{} {}".format(sampleName, formatLabels(labels), formatValue(value)))
+	return "\n".join(lines) + "\n"
@@ -0,0 +1,165 @@
+############################################################################
+# PYBUS REPLAY
+# FEEDS RECORDED BUS TRAFFIC THROUGH IBUSFACE IN PLACE OF A REAL SERIAL PORT,
+# SO THE WHOLE READ -> MANAGE -> SESSION PIPELINE RUNS WITHOUT A CAR
+############################################################################
+
+import os
+import re
+import ast
+import time
+import fcntl
+import select
+import struct
+import termios
+import logging
+import threading
+
+import pyBus_capture as pB_capture
+
+#####################################
+# CONFIG
+#####################################
+BYTE_TIME = 11.0 / 9600 # seconds a byte takes on the wire, used to space out frames from text logs
+FRAME_GAP = 0.002 # seconds between frames from text logs, which don't carry timestamps
+
+# A 'READ: [src -> dst] ['50', '04', '68', ['3B', '01'], '06']' line as logged by ibusFace
+READ_LINE = re.compile(r"READ: \[.*\] (\[.*\])\s*$")
+
+#####################################
+# SOURCES
+# Each yields (timestamp in seconds, raw frame) in order
+#####################################
+def captureFrames(path):
+	reader = pB_capture.ibusCaptureReader(path)
+	try:
+		for timestamp, frame in reader.frames():
+			yield timestamp, frame
+	finally:
+		reader.close()
+
+def logFrames(path):
+	timestamp = 0.0
+	with open(path) as log:
+		for line in log:
+			match = READ_LINE.search(line)
+			if not match:
+				continue
+			try:
+				src, length, dst, dat, xor = ast.literal_eval(match.group(1))
+				frame = bytearray.fromhex(str(src + length + dst + ''.join(dat) + xor))
+			except (ValueError, SyntaxError, TypeError):
+				logging.debug("Skipping unreadable log line: {}".format(line.strip()))
+				continue
+			yield timestamp, frame
+			timestamp += len(frame) * BYTE_TIME + FRAME_GAP
+
+# Frames from a capture file or a text log, whichever path is
+def openFrames(path):
+	with open(path, "rb") as source:
+		magic = source.read(len(pB_capture.MAGIC))
+	if magic == pB_capture.MAGIC:
+		return captureFrames(path)
+	return logFrames(path)
+
+#------------------------------------
+# CLASS standing in for serial.Serial, for the parts ibusFace uses
+# Frames are written into a pipe by a feeder thread at their recorded pace (scaled by speed, 0 for as fast as possible),
+# so the read end behaves like a port: it can be selected on, polled for waiting bytes and read with a timeout.
+#------------------------------------
+class replaySerial ( ):
+	def __init__(self, path, speed=1.0, timeout=0.5):
+		self.PATH = path
+		self.SPEED = float(speed)
+		self.timeout = timeout
+		self.READ_FD, self.WRITE_FD = os.pipe()
+		self.finished = threading.Event() # set once every frame has been fed in
+		self.frames = 0
+		self.written = 0
+		self.startTime = time.time()
+
+		self.FEEDER = threading.Thread(target=self.feed, args=(openFrames(path),), name="replayFeeder")
+		self.FEEDER.daemon = True
+		self.FEEDER.start()
+		logging.info("Replaying {} at {}".format(path, "full speed" if not self.SPEED else "{}x".format(self.SPEED)))
+
+	def feed(self, frames):
+		first = None
+		try:
+			for timestamp, frame in frames:
+				if self.SPEED:
+					if first is None:
+						first = timestamp
+					wait = (timestamp - first) / self.SPEED - (time.time() - self.startTime)
+					if wait > 0:
+						time.sleep(wait)
+				os.write(self.WRITE_FD, bytes(frame))
+				self.frames += 1
+		except OSError:
+			pass # closed under us
+		except Exception, e:
+			logging.error("Replay of {} failed: {}".format(self.PATH, e))
+		finally:
+			logging.info("Replayed {} frames from {}".format(self.frames, self.PATH))
+			self.closeWriter()
+			self.finished.set()
+
+	def closeWriter(self):
+		fd, self.WRITE_FD = self.WRITE_FD, None
+		if fd is not None:
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+
+	def fileno(self):
+		return self.READ_FD
+
+	@property
+	def in_waiting(self):
+		buf = fcntl.ioctl(self.READ_FD, termios.FIONREAD, struct.pack("i", 0))
+		return struct.unpack("i", buf)[0]
+
+	def inWaiting(self):
+		return self.in_waiting
+
+	# Like a port, wait up to timeout for size bytes and return what arrived
+	def read(self, size=1):
+		data = ""
+		deadline = time.time() + self.timeout
+		while len(data) < size:
+			remaining = deadline - time.time()
+			if remaining <= 0 or not select.select([self.READ_FD], [], [], remaining)[0]:
+				break
+			chunk = os.read(self.READ_FD, size - len(data))
+			if not chunk:
+				break # feeder is done
+			data += chunk
+		return data
+
+	# Writes go nowhere, there is no bus to put them on
+	def write(self, data):
+		self.written += len(data)
+		return len(data)
+
+	def flush(self):
+		pass
+
+	def flushInput(self):
+		pass
+
+	def setDTR(self, value=True):
+		pass
+
+	def getCTS(self):
+		return True
+
+	# Whether everything has been fed in and read back out
+	def exhausted(self):
+		return self.finished.is_set() and not self.in_waiting
+
+	def close(self):
+		self.closeWriter()
+		fd, self.READ_FD = self.READ_FD, None
+		if fd is not None:
+			os.close(fd)
@@ -3,13 +3,40 @@
 # USED AS INTERFACE BETWEEN PYBUS AND A CENTRAL REST API
 ############################################################################
 
+import time
+import Queue
 import logging
-import requests
+import threading
+import pyBus_http as pB_http # Pooled keep-alive HTTP client
+import pyBus_spool as pB_spool # On-disk spool for updates MDroid-Core couldn't take
+import pyBus_metrics as pB_metrics # Counters and histograms for /metrics
+import pyBus_store as pB_store # Typed, versioned store for the local session
+
+#####################################
+# CONFIG
+#####################################
+UPLOAD_WINDOW = 0.25 # seconds updates are collected for before being sent, repeated writes to a key in this window are merged
+RETRY_INTERVAL = 5 # seconds between attempts to reach MDroid-Core once it has failed, updates are spooled meanwhile
+SUBSCRIBER_DEPTH = 512 # changes buffered per change stream subscriber before they start missing some
+
+# Per key limits on how often a changing value is sent. A new value only goes out once it has moved by at least
+# 'deadband' since the last one sent, or 'interval' seconds have passed. Unchanged values are never re-sent.
+RATE_LIMITS = {
+	"SPEED" : {"interval" : 1, "deadband" : 2},
+	"RPM" : {"interval" : 1, "deadband" : 100}
+}
+
+UPLOAD_LATENCY = pB_metrics.histogram("pybus_session_upload_seconds", "Time taken to send a batch of session updates to MDroid-Core")
+UPLOAD_FAILURES = pB_metrics.counter("pybus_session_upload_failures_total", "Batches of session updates MDroid-Core didn't take")
+UPLOADED = pB_metrics.counter("pybus_session_updates_sent_total", "Session updates sent to MDroid-Core")
 
 class ibusSession():
 
 	# Define MDroid-Core api url if applicable
-	def __init__(self, init_with_api=False):
+	# rateLimits adds to / overrides RATE_LIMITS, e.g. {"SPEED" : {"interval" : 1, "deadband" : 2}}
+	# spoolPath is where updates are kept while MDroid-Core is unreachable, None to just drop them
+	# series, a pyBus_timeseries.ibusTimeSeries, gets a point for every numeric update
+	def __init__(self, init_with_api=False, rateLimits=None, spoolPath=pB_spool.SPOOL_PATH, spoolMaxBytes=pB_spool.MAX_BYTES, series=None):
 
 		# Make requests a little quieter
 		logging.getLogger("requests").setLevel(logging.CRITICAL)
@@ -18,38 +45,224 @@ class ibusSession():
 		# if we're extending functionality with external MDroid-Core
 		self.API = init_with_api
 
-		# Set up local dict for storing session
-		self.data = dict()
-		
+		# Local session, values are kept as the directives passed them
+		self.STORE = pB_store.ibusStore()
+
+		# History of numeric values, if kept
+		self.SERIES = series
+
+		# Queue : store listener, for everyone following changes, see subscribe()
+		self.SUBSCRIBERS = dict()
+
+		# Updates waiting for the uploader, only the latest value per key is kept
+		self.PENDING = dict()
+		self.PENDING_LOCK = threading.Condition()
+		self.BULK = True # cleared if MDroid-Core doesn't take bulk updates, then keys are sent one by one
+
+		# Last value handed to the uploader per key, as (normalized value, number or None, time)
+		self.SENT = dict()
+		self.RATE_LIMITS = dict(RATE_LIMITS)
+		for key, limit in (rateLimits or {}).items():
+			limit = dict((str(k).lower(), v) for k, v in limit.items())
+			self.RATE_LIMITS[str(key).upper()] = {"interval" : float(limit.get("interval", 0)), "deadband" : float(limit.get("deadband", 0))}
+		self.running = True
+
+		# Updates that failed to send, replayed in one go once MDroid-Core answers again
+		self.SPOOL = None
+		self.retryAt = 0
+		if self.API and spoolPath:
+			self.SPOOL = pB_spool.ibusSpool(spoolPath, int(spoolMaxBytes))
+
 		if not self.API:
 			logging.info("Not using API, building internal session dict instead")
+		else:
+			self.UPLOADER = threading.Thread(target=self.uploadLoop, name="sessionUploader")
+			self.UPLOADER.daemon = True
+			self.UPLOADER.start()
+
+			pB_metrics.collect("pybus_session_pending", "Session updates waiting for the uploader", "gauge", lambda: len(self.PENDING))
+			pB_metrics.collect("pybus_session_spooled_bytes", "Bytes of session updates spooled to disk", "gauge",
+				lambda: self.SPOOL.size if self.SPOOL else 0)
 
 	# Allows for easier logging of update timing
 	def updateData(self, key, data):
-		# Keep a copy in our local dict
-		self.data[str(key).upper()] = str(data).upper()
+		# Keep it in the local store, which tells anyone following along if it changed
+		localKey = str(key).upper()
+		self.STORE.set(localKey, data)
 
-		# Write entry to main REST server
+		# Numbers are kept as they are for charting, repeats included so the series shows how long a value held
+		if self.SERIES is not None and isinstance(data, (int, long, float)) and not isinstance(data, bool):
+			self.SERIES.add(localKey, data)
+
+		# Hand the entry to the uploader for the main REST server, this never waits on the network
 		if self.API:
-			# Ignore speed and RPM / SPEED
-			if key is not "RPM" and key is not "SPEED":
-				url = self.API+"/session/"+key
-				dataString = {"value": data}
-				r = requests.post(url, json=dataString, headers={'Content-type': 'application/json'})
+			value = str(data).upper()
+			with self.PENDING_LOCK:
+				if not self.hasChanged(key, data, value):
+					return
+				self.PENDING[key] = data
+				self.PENDING_LOCK.notify()
+
+	# Whether an update is worth sending, i.e. the value changed and its rate limit allows it.
+	# Records it as sent if so, call with PENDING_LOCK held
+	def hasChanged(self, key, data, value):
+		now = time.time()
+		number = data if isinstance(data, (int, long, float)) and not isinstance(data, bool) else None
+
+		last = self.SENT.get(key)
+		if last is not None:
+			lastValue, lastNumber, lastTime = last
+			if value == lastValue:
+				return False
+
+			limit = self.RATE_LIMITS.get(str(key).upper())
+			if limit:
+				moved = number is not None and lastNumber is not None and abs(number - lastNumber) >= limit["deadband"]
+				if not moved and now - lastTime < limit["interval"]:
+					return False
+
+		self.SENT[key] = (value, number, now)
+		return True
+
+	# Uploader thread, sends whatever has collected over UPLOAD_WINDOW in one request
+	def uploadLoop(self):
+		while True:
+			with self.PENDING_LOCK:
+				while self.running and not self.PENDING:
+					self.PENDING_LOCK.wait()
+				if not self.running and not self.PENDING:
+					return
+
+			# Let more updates pile up (and merge) before sending
+			if self.running:
+				time.sleep(UPLOAD_WINDOW)
+
+			with self.PENDING_LOCK:
+				batch = self.PENDING
+				self.PENDING = dict()
+
+			self.deliver(batch)
+
+	# Send a batch along with anything spooled while MDroid-Core was down, spooling whatever doesn't make it
+	def deliver(self, batch):
+		replaying = False
+		if self.SPOOL and self.SPOOL.pending():
+			if time.time() < self.retryAt:
+				self.SPOOL.append(batch) # still backing off, don't bother trying
+				return
+			replaying = True
+			spooled = self.SPOOL.load()
+			spooled.update(batch)
+			batch = spooled
+
+		started = time.time()
+		try:
+			failed = self.upload(batch)
+		except Exception, e:
+			logging.debug("API request failed during data POST: {}".format(e))
+			failed = batch
+		UPLOAD_LATENCY.observe(time.time() - started)
+		UPLOADED.inc(len(batch) - len(failed))
+
+		if not failed:
+			if replaying:
+				logging.info("Sent {} spooled session updates".format(len(batch)))
+				self.SPOOL.clear()
+			return
+
+		UPLOAD_FAILURES.inc()
+		if self.SPOOL:
+			if replaying:
+				# What did go through must not be replayed again, an older spooled value would overwrite a newer one sent since
+				self.SPOOL.replace(failed)
+			else:
+				self.SPOOL.append(failed)
+			self.retryAt = time.time() + RETRY_INTERVAL
+
+	# Send a batch of {key : value} to MDroid-Core, returns whatever couldn't be sent
+	def upload(self, batch):
+		if self.BULK:
+			url = self.API+"/session"
+			dataString = [{"name": key, "value": value} for key, value in batch.items()]
+			r = pB_http.CLIENT.post(url, json=dataString, headers={'Content-type': 'application/json'})
+			if r.status_code in (404, 405):
+				logging.info("MDroid-Core doesn't take bulk session updates, sending keys one at a time")
+				self.BULK = False
+			else:
 				if r.status_code != 200:
-					logging.debug("API request failed during data POST: "+r.reason)
+					logging.debug("API request failed during bulk data POST: "+r.reason)
 					logging.debug(url)
-					logging.debug(r.json)
+					return batch
+				return dict()
+
+		failed = dict()
+		for key, value in batch.items():
+			url = self.API+"/session/"+key
+			dataString = {"value": value}
+			try:
+				r = pB_http.CLIENT.post(url, json=dataString, headers={'Content-type': 'application/json'})
+			except Exception, e:
+				logging.debug("API request failed during data POST: {}".format(e))
+				failed[key] = value
+				continue
+			if r.status_code != 200:
+				logging.debug("API request failed during data POST: "+r.reason)
+				logging.debug(url)
+				failed[key] = value
+		return failed
+
+	# Latest value of a key, or default if it hasn't been seen yet
+	def get(self, key, default=None):
+		return self.STORE.get(key, default)
+
+	# Consistent copy of the local session, shared with other readers so don't modify it
+	def snapshot(self):
+		return self.STORE.snapshot()
+
+	# Read only view of the local session, kept for directives written against the old dict
+	@property
+	def data(self):
+		return self.STORE.snapshot()
+
+	# (version, {key : value} changed since the given version), pass the version back in next time
+	def changedSince(self, version):
+		return self.STORE.changedSince(version)
+
+	# Follow changes to the local session. Returns the current snapshot and a queue that gets a (key, value)
+	# for every key that changes from here on, with nothing missed in between
+	def subscribe(self):
+		subscriber = Queue.Queue(SUBSCRIBER_DEPTH)
+		def listener(key, value):
+			try:
+				subscriber.put_nowait((key, value))
+			except Queue.Full:
+				pass # they've stopped reading, don't let them hold us up
+		self.SUBSCRIBERS[subscriber] = listener
+		return self.STORE.watch(listener), subscriber
+
+	def unsubscribe(self, subscriber):
+		listener = self.SUBSCRIBERS.pop(subscriber, None)
+		if listener:
+			self.STORE.unwatch(listener)
+
+	# Send anything still waiting and stop the uploader
+	def close(self):
+		if not self.API:
+			return
+		with self.PENDING_LOCK:
+			self.running = False
+			self.PENDING_LOCK.notify()
+		self.UPLOADER.join(5)
 
 	# Checks for any external messages sent to socket,
 	def checkExternalMessages(self):
 		# Write entry to main REST server
 		if self.API:
-			r = requests.get(self.API+"/pybus/queue")
+			r = pB_http.CLIENT.get(self.API+"/pybus/queue")
 			if r.status_code == 200:
 				message = r.json()
 				if message != "{}":
 					logging.info("Got External Message: {}".format(message))
 				return message
 			else:
-				logging.debug("API request failed during external messages GET: "+r.reason)
\ No newline at end of file
+				logging.debug("API request failed during external messages GET: "+r.reason)
@@ -0,0 +1,376 @@
+############################################################################
+# PYBUS SIGNALS
+# DECLARATIVE DEFINITIONS OF THE VALUES CARRIED IN BROADCAST MESSAGES, COMPILED INTO FAST DECODERS
+#
+# A decoder maps message ids (the first data byte, or (id, second byte) for messages with a sub id)
+# to the signals found in them. Each signal says where it sits in the payload and how to turn the raw
+# bytes into a session value. At startup a decoder's table is built into per message field readers,
+# so each field is read straight off the payload bytes in a single pass, with no hex strings or
+# int(x, 16) involved (see ibusMessage).
+#
+# To decode something new, add a signal() to the table below, nothing else needs to change.
+############################################################################
+
+import struct
+import binascii
+
+#####################################
+# SIGNAL DEFINITIONS
+#####################################
+# Kinds of raw value
+UINT = "uint" # unsigned integer, 1 to 4 bytes
+INT = "int" # signed integer, 1, 2 or 4 bytes
+HEX = "hex" # upper case hex string of the bytes, e.g. for enum'ing a whole status block
+ASCII = "ascii" # the bytes as a string
+BYTES = "bytes" # the bytes as a string, for a transform to pick apart
+
+# Byte order of multi byte integers
+BIG = ">"
+LITTLE = "<"
+
+SKIP = object() # value() result for a raw value that shouldn't update the session
+
+INT_CODES = {1 : "b", 2 : "h", 4 : "i"}
+
+#------------------------------------
+# CLASS for one value in a message
+# offset / size are in bytes from the start of the payload (the message id is byte 0). size None runs to the end of the payload.
+# The raw value is shifted right by shift and masked with mask, then:
+#   - if it is in invalid, nothing is updated (e.g. a sensor reporting 'not available')
+#   - if there's an enum, the value is looked up in it and nothing is updated when it isn't there
+#   - otherwise it's raw * scale + add
+# and transform, if given, is applied last for anything the above doesn't cover.
+#------------------------------------
+class ibusSignal ( object ):
+	__slots__ = ('key', 'offset', 'size', 'kind', 'endian', 'scale', 'add', 'mask', 'shift', 'enum', 'invalid', 'transform', 'convert')
+
+	def __init__(self, key, offset, size=1, kind=UINT, endian=BIG, scale=1, add=0, mask=None, shift=0, enum=None, invalid=(), transform=None):
+		if kind in (UINT, INT) and size not in (1, 2, 3, 4):
+			raise ValueError("Signal %s: integers are 1 to 4 bytes, not %s" % (key, size))
+		if kind == INT and size == 3:
+			raise ValueError("Signal %s: signed integers can't be 3 bytes" % key)
+		self.key = key
+		self.offset = offset
+		self.size = size
+		self.kind = kind
+		self.endian = endian
+		self.scale = scale
+		self.add = add
+		self.mask = mask
+		self.shift = shift
+		self.enum = enum
+		self.invalid = frozenset(invalid)
+		self.transform = transform
+		self.convert = self.converter()
+
+	# Where the raw value comes from. Signals sharing one are only unpacked once
+	def field(self):
+		if self.kind in (UINT, INT):
+			return (self.offset, self.size, self.kind, self.endian)
+		return (self.offset, self.size, self.kind, BIG)
+
+	# The session value for a raw value, or SKIP
+	def value(self, raw):
+		return raw if self.convert is None else self.convert(raw)
+
+	# Function doing what value() does, built once with the settings held in locals.
+	# None if the signal passes raw values on unchanged, so decoders can skip the call
+	def converter(self):
+		shift, mask, invalid, enum, transform = self.shift, self.mask, self.invalid, self.enum, self.transform
+		scale, add = self.scale, self.add
+		scaled = scale != 1 or add
+		if not (shift or mask is not None or invalid or enum is not None or scaled or transform):
+			return None
+
+		def value(raw):
+			if shift:
+				raw >>= shift
+			if mask is not None:
+				raw &= mask
+			if raw in invalid:
+				return SKIP
+			if enum is not None:
+				return enum.get(raw, SKIP)
+			if scaled:
+				raw = raw * scale + add
+			if transform:
+				raw = transform(raw)
+			return raw
+		return value
+
+# Shorthand for the tables
+signal = ibusSignal
+
+#------------------------------------
+# CLASS for the signals of one message
+# Built once into a reader per distinct field and a (key, field, signal.convert) step per signal, so decoding a
+# payload is a length check, each field read once straight off the payload bytes, then one updateData per signal.
+#------------------------------------
+class ibusMessage ( object ):
+	def __init__(self, signals):
+		self.SIGNALS = list(signals)
+
+		# Shortest payload holding every field
+		self.LENGTH = 0
+		for sig in self.SIGNALS:
+			self.LENGTH = max(self.LENGTH, sig.offset + (sig.size or 0))
+
+		fields = []
+		readers = []
+		steps = []
+		for sig in self.SIGNALS:
+			if sig.field() not in fields:
+				fields.append(sig.field())
+				readers.append(fieldReader(sig))
+			steps.append((sig.key, fields.index(sig.field()), sig.convert))
+		self.READERS = tuple(readers)
+		self.STEPS = tuple(steps)
+
+	# Pass every signal in the payload to updateData(key, value), returns how many were passed on
+	def update(self, updateData, payload):
+		if len(payload) < self.LENGTH:
+			return 0
+		fields = [read(payload) for read in self.READERS]
+		updated = 0
+		for key, index, convert in self.STEPS:
+			raw = fields[index] if convert is None else convert(fields[index])
+			if raw is not SKIP:
+				updateData(key, raw)
+				updated += 1
+		return updated
+
+# Function reading a signal's raw field out of payload (a bytearray)
+def fieldReader(sig):
+	offset, size, kind = sig.offset, sig.size, sig.kind
+	end = None if size is None else offset + size
+	if kind == HEX:
+		return lambda payload: binascii.hexlify(bytes(payload[offset:end])).upper()
+	if kind in (ASCII, BYTES):
+		return lambda payload: bytes(payload[offset:end])
+	if kind == INT:
+		unpack = struct.Struct(sig.endian + INT_CODES[size]).unpack_from
+		return lambda payload: unpack(payload, offset)[0]
+	if size == 1:
+		return lambda payload: payload[offset]
+
+	# Unsigned, shifted together byte by byte
+	order = range(offset, end)
+	if sig.endian == LITTLE:
+		order.reverse()
+	def read(payload):
+		raw = 0
+		for byte in order:
+			raw = (raw << 8) | payload[byte]
+		return raw
+	return read
+
+#------------------------------------
+# CLASS for decoding every message a directive handles
+# messages maps a message id, or (id, sub id), to its signals. otherwise holds signals decoded when
+# the message isn't known or nothing in it applied, always holds signals decoded from every payload.
+#
+# Tables are built into ibusMessages once, so a payload costs one dict lookup for its message and a single pass
+# over that message's signals, each converted by its ibusSignal (see ibusSignal.converter).
+#------------------------------------
+class ibusDecoder ( object ):
+	def __init__(self, messages, otherwise=(), always=(), name="decoder"):
+		self.NAME = name
+		self.MESSAGES = dict()
+		for key, signals in messages.items():
+			if isinstance(key, tuple):
+				self.MESSAGES.setdefault(key[0], dict())[key[1]] = ibusMessage(signals)
+			else:
+				self.MESSAGES[key] = ibusMessage(signals)
+		self.OTHERWISE = ibusMessage(otherwise) if otherwise else None
+		self.ALWAYS = ibusMessage(always) if always else None
+
+	# Pass every signal in the payload to updateData(key, value), e.g. the session's updateData
+	def update(self, updateData, payload):
+		length = len(payload)
+		message = self.MESSAGES.get(payload[0]) if length else None
+		if isinstance(message, dict):
+			message = message.get(payload[1]) if length > 1 else None
+
+		updated = message.update(updateData, payload) if message else 0
+		if self.OTHERWISE and not updated:
+			self.OTHERWISE.update(updateData, payload)
+		if self.ALWAYS:
+			self.ALWAYS.update(updateData, payload)
+
+	# [(key, value)] for every signal in the payload
+	def decode(self, payload):
+		results = []
+		self.update(lambda key, value: results.append((key, value)), payload)
+		return results
+
+#------------------------------------
+# CLASS for one flag in a status byte
+# Passes on, when set, and off, when clear. mask can cover several bits, the flag is set if any of them are.
+#------------------------------------
+class ibusBit ( object ):
+	__slots__ = ('key', 'offset', 'mask', 'on', 'off')
+
+	def __init__(self, key, offset, mask, on=True, off=False):
+		if not 0 < mask <= 0xFF:
+			raise ValueError("Bit %s: mask must be within one byte, not %s" % (key, mask))
+		self.key = key
+		self.offset = offset
+		self.mask = mask
+		self.on = on
+		self.off = off
+
+# Shorthand for the tables
+bit = ibusBit
+
+#------------------------------------
+# CLASS for status bytes where every bit is a flag, e.g. doors / windows or lamps
+# Bits are tested as integer masks straight off the payload. The last value of each byte is kept, and only the
+# bits that changed since the previous frame are passed on, so a repeated status costs one compare per byte.
+# The first frame after reset() passes on every bit. If message is given, other messages are ignored.
+# Last values are kept per bus, so the same status seen on the I-BUS and K-BUS is tracked separately.
+#
+# The last values aren't locked: every packet of a stream is handled by the same worker, in order (see pyBus_workerPool).
+#------------------------------------
+class ibusBitfield ( object ):
+	def __init__(self, bits, message=None):
+		self.MESSAGE = message
+		grouped = dict()
+		for flag in bits:
+			grouped.setdefault(flag.offset, []).append((flag.mask, flag.key, flag.on, flag.off))
+		self.BYTES = tuple((offset, tuple(flags)) for offset, flags in sorted(grouped.items()))
+		self.LENGTH = max(grouped) + 1 if grouped else 0
+		self.reset()
+
+	# Forget the last frame on every bus, so every bit is passed on from the next one
+	def reset(self):
+		self.last = dict() # bus id : {offset : last value}
+
+	# [(key, value)] for every bit that changed since the last frame from the same bus
+	def changes(self, payload, bus=None):
+		found = []
+		if len(payload) < self.LENGTH or (self.MESSAGE is not None and payload[0] != self.MESSAGE):
+			return found
+
+		last = self.last.get(bus)
+		if last is None:
+			last = self.last[bus] = dict((offset, None) for offset, flags in self.BYTES)
+		for offset, flags in self.BYTES:
+			value = payload[offset]
+			previous = last[offset]
+			if value == previous:
+				continue
+			last[offset] = value
+			changed = 0xFF if previous is None else value ^ previous
+			for mask, key, on, off in flags:
+				if changed & mask:
+					found.append((key, on if value & mask else off))
+		return found
+
+	# Pass every changed bit to updateData(key, value), e.g. the session's updateData
+	def update(self, updateData, payload, bus=None):
+		for key, value in self.changes(payload, bus):
+			updateData(key, value)
+
+############################################################################
+# SIGNAL TABLES
+############################################################################
+
+# IKE (instrument cluster) broadcasts, 80 -> BF
+IKE = ibusDecoder(name="IKE", messages={
+	# Ignition status
+	0x11 : [
+		signal("KEY_STATE", 1, enum={0x00 : False, 0x01 : "POS_1", 0x03 : "POS_2", 0x07 : "START"})
+	],
+	# Sensor status, broadcast every 10 seconds. Haven't decoded most of this one yet, the known bits are in IKE_SENSORS
+	0x13 : [
+		signal("IKE_SENSOR_STATUS", 1, 7, HEX),
+		signal("OUTSIDE_TEMP_2", 7) # in c
+	],
+	# Odometer reading, in response to request
+	0x17 : [
+		signal("ODOMETER", 1, 3, endian=LITTLE)
+	],
+	# Speed / RPM, broadcast every 2 seconds
+	0x18 : [
+		signal("SPEED", 1, scale=2),
+		signal("RPM", 2, scale=100)
+	],
+	# Temperatures, broadcast every 10 seconds
+	0x19 : [
+		signal("OUTSIDE_TEMP", 1),
+		signal("COOLANT_TEMP", 2, invalid=(128,)),
+		signal("OIL_TEMP", 3) # Only for european models I believe, or if you've set this to be tracked with INPA/NCS. Otherwise 0
+	],
+	# OBC estimated range / average speed
+	(0x24, 0x06) : [
+		signal("RANGE_KM", 3, 4)
+	],
+	(0x24, 0x0A) : [
+		signal("AVG_SPEED", 3, 4)
+	]
+})
+
+# IKE sensor status flags, 80 -> BF 0x13
+IKE_SENSORS = ibusBitfield(message=0x13, bits=[
+	bit("HANDBRAKE", 1, 0x01),
+	bit("OIL_PRESSURE", 1, 0x02, on="LOW", off="OK")
+])
+
+# Vehicle data (VIN, service info) from the LCM, D0 -> 80, in response to a request
+VEHICLE_DATA = ibusDecoder(name="VEHICLE_DATA", messages={
+	0x54 : [
+		# VIN, the first two model letters are ASCII and the rest is BCD
+		signal("VIN", 1, 5, BYTES, transform=lambda raw: raw[:2] + binascii.hexlify(raw[2:]).upper()[:5]),
+		# Odometer, rounded to the nearest hundred in KM
+		signal("ODOMETER_ESTIMATE", 6, 2, scale=100),
+		# Liters since last service, first byte and first 4 bits in second byte. I.E. '58 02' would be 88+0 or 880 liters
+		signal("LITERS_SINCE_LAST_SERVICE", 9, 2, BYTES, transform=lambda raw: str(ord(raw[0])) + str(ord(raw[1]) >> 4)),
+		signal("DAYS_SINCE_LAST_SERVICE", 12, 2)
+	]
+})
+
+# Rain / light sensor, E8 -> D0
+RAIN_LIGHT_SENSOR = ibusDecoder(name="RAIN_LIGHT_SENSOR", messages={
+	0x59 : [
+		signal("LIGHT_SENSOR_REASON", 2, enum={0x01 : "TWILIGHT", 0x02 : "DARKNESS", 0x04 : "RAIN", 0x08 : "TUNNEL", 0x10 : "BASEMENT_GARAGE"}),
+		signal("LIGHT_SENSOR_ON", 1, mask=0x0F, enum={0x01 : True, 0x00 : False}),
+		signal("LIGHT_SENSOR_INTENSITY", 1, shift=4, mask=0x0F, transform=lambda nibble: "%X" % nibble)
+	]},
+	always=[signal("RAIN_LIGHT_SENSOR_STATUS", 0, None, HEX)]
+)
+
+# Integrated heating and air conditioning, 5B -> 80
+CLIMATE_CONTROL = ibusDecoder(name="CLIMATE_CONTROL", messages={
+	0x83 : [
+		signal("AIR_CONDITIONING_ON", 1, None, HEX, enum={"0000" : False, "8008" : True})
+	]},
+	otherwise=[signal("CLIMATE_CONTROL_STATUS", 0, None, HEX)]
+)
+
+# Door / window status, 00 -> BF 0x7A, in response to a status request or when something changes.
+# LOCKED / UNLOCKED aren't session keys, d_windowDoorMessage turns them into d_carLocked / d_carUnlocked
+DOORS_WINDOWS = ibusBitfield(message=0x7A, bits=[
+	bit("LOCKED", 1, 0x20),
+	bit("UNLOCKED", 1, 0x10),
+	# 0x04 / 0x08 are likely the rear doors, unused in coupes / convertibles obviously
+	bit("DOOR_OPEN_PASSENGER", 1, 0x02),
+	bit("DOOR_OPEN_DRIVER", 1, 0x01),
+	bit("HOOD_OPEN", 2, 0x40),
+	bit("WINDOW_OPEN_PASSENGER_REAR", 2, 0x08),
+	bit("WINDOW_OPEN_DRIVER_REAR", 2, 0x04),
+	bit("WINDOW_OPEN_PASSENGER_FRONT", 2, 0x02),
+	bit("WINDOW_OPEN_DRIVER_FRONT", 2, 0x01)
+])
+
+# Lamp status from the LCM, D0 -> BF 0x5B. e.g. 5B 60 00 04 00 is both indicators on, in sync, no bulbs out
+LAMP_STATUS = ibusBitfield(message=0x5B, bits=[
+	bit("LIGHTS_PARKING", 1, 0x01),
+	bit("LIGHTS_LOW_BEAM", 1, 0x02),
+	bit("LIGHTS_HIGH_BEAM", 1, 0x04),
+	bit("LIGHTS_FOG_FRONT", 1, 0x08),
+	bit("LIGHTS_FOG_REAR", 1, 0x10),
+	bit("INDICATOR_LEFT", 1, 0x20),
+	bit("INDICATOR_RIGHT", 1, 0x40),
+	bit("INDICATOR_FAST", 1, 0x80), # fast blink, a bulb is out
+	bit("INDICATOR_SYNC", 3, 0x04)
+])
@@ -0,0 +1,115 @@
+############################################################################
+# PYBUS SPOOL
+# KEEPS SESSION UPDATES ON DISK WHILE MDROID-CORE CAN'T BE REACHED,
+# SO THEY CAN BE SENT ONCE IT COMES UP
+############################################################################
+
+import os
+import json
+import logging
+import threading
+
+#####################################
+# CONFIG
+#####################################
+SPOOL_PATH = "/var/tmp/pyBus_session.spool" # /var/tmp survives a reboot, unlike /tmp on most Pis
+MAX_BYTES = 256 * 1024 # spool is compacted down to the latest value per key once it grows past this
+
+#------------------------------------
+# CLASS for an append-only spool of {key : value} updates
+# One JSON object per line, appended as batches fail. Later lines supersede earlier ones for the same key,
+# so compacting is just rewriting the file with the latest value per key.
+#------------------------------------
+class ibusSpool ( ):
+	def __init__(self, path=SPOOL_PATH, maxBytes=MAX_BYTES):
+		self.PATH = path
+		self.MAX_BYTES = maxBytes
+		self.LOCK = threading.Lock()
+		self.size = 0
+		try:
+			self.size = os.path.getsize(self.PATH)
+		except OSError:
+			pass
+		if self.size:
+			logging.info("Found %d bytes of spooled session updates in %s" % (self.size, self.PATH))
+
+	# Whether anything is waiting to be replayed
+	def pending(self):
+		return self.size > 0
+
+	# Add a batch of updates, durably
+	def append(self, batch):
+		if not batch:
+			return
+		line = json.dumps(batch, separators=(',', ':')) + "\n"
+		with self.LOCK:
+			try:
+				with open(self.PATH, "a") as spool:
+					spool.write(line)
+					spool.flush()
+					os.fsync(spool.fileno())
+				self.size += len(line)
+			except (IOError, OSError), e:
+				logging.error("Failed to spool session updates to %s: %s" % (self.PATH, e))
+				return
+
+			if self.size > self.MAX_BYTES:
+				self.compact()
+
+	# Everything spooled, merged down to the latest value per key
+	def load(self):
+		with self.LOCK:
+			return self.read()
+
+	# Swap everything spooled for just this batch, e.g. what's left after a replay only partly went through
+	def replace(self, batch):
+		with self.LOCK:
+			self.rewrite(batch)
+
+	# Drop everything, call once it has been delivered
+	def clear(self):
+		with self.LOCK:
+			try:
+				os.remove(self.PATH)
+			except OSError:
+				pass
+			self.size = 0
+
+	def read(self):
+		merged = dict()
+		try:
+			with open(self.PATH) as spool:
+				for line in spool:
+					try:
+						merged.update(json.loads(line))
+					except ValueError:
+						logging.debug("Skipping damaged spool line") # most likely cut short by a power loss
+		except IOError:
+			pass
+		return merged
+
+	# Rewrite the spool with only the latest value per key. Called with LOCK held
+	def compact(self):
+		merged = self.read()
+		if self.rewrite(merged):
+			logging.debug("Compacted session spool to %d keys" % len(merged))
+
+	# Replace the spool with one line holding merged, atomically. Called with LOCK held, returns whether it worked
+	def rewrite(self, merged):
+		line = json.dumps(merged, separators=(',', ':')) + "\n" if merged else ""
+		if len(line) > self.MAX_BYTES:
+			logging.warning("Spooled session is %d bytes even after compacting, dropping it" % len(line))
+			merged, line = dict(), ""
+
+		tmpPath = self.PATH + ".tmp"
+		try:
+			with open(tmpPath, "w") as spool:
+				spool.write(line)
+				spool.flush()
+				os.fsync(spool.fileno())
+			os.rename(tmpPath, self.PATH)
+			self.size = len(line)
+			return True
+		except (IOError, OSError), e:
+			logging.error("Failed to rewrite session spool %s: %s" % (self.PATH, e))
+			return False
@@ -0,0 +1,89 @@
+############################################################################
+# PYBUS STORE
+# THE LOCAL SESSION: LATEST VALUE OF EVERY KEY, AS THE DIRECTIVES DECODED IT (True, 42, "POS_1"...)
+#
+# Each key gets a slot the first time it's set, values and versions are kept by slot. Every change bumps
+# a global version and stamps it on the key, so changedSince(N) is all a poller needs to keep up.
+############################################################################
+
+import array
+import threading
+
+#------------------------------------
+# CLASS for the session values
+# Writes take LOCK, reads don't: get() reads one slot, snapshot() hands out a dict that is never written to again
+# once published (copy-on-write, it's only rebuilt the first time it's asked for after a change).
+#------------------------------------
+class ibusStore ( object ):
+	def __init__(self):
+		self.LOCK = threading.Lock()
+		self.IDS = dict() # interned key : slot
+		self.KEYS = [] # slot : key
+		self.VALUES = [] # slot : value
+		self.VERSIONS = array.array('L') # slot : version it last changed in
+		self.version = 0 # bumped on every change
+		self.LISTENERS = [] # called with (key, value) for every change, see watch()
+		self.cache = None # published snapshot, None once something has changed since
+
+	# Set a key, returns the new version if the value changed, otherwise 0.
+	# True and 1 (or 2 and 2.0) are different values here, as they'd be sent / shown differently
+	def set(self, key, value):
+		with self.LOCK:
+			slot = self.IDS.get(key)
+			if slot is None:
+				key = intern(key)
+				slot = len(self.KEYS)
+				self.KEYS.append(key)
+				self.VALUES.append(value)
+				self.VERSIONS.append(0)
+				self.IDS[key] = slot # last, get() doesn't lock, so the slot has to be filled before anyone can find it
+			else:
+				old = self.VALUES[slot]
+				if old == value and type(old) is type(value):
+					return 0
+				self.VALUES[slot] = value
+
+			self.version += 1
+			self.VERSIONS[slot] = self.version
+			self.cache = None
+			for listener in self.LISTENERS:
+				listener(key, value)
+			return self.version
+
+	def get(self, key, default=None):
+		slot = self.IDS.get(key)
+		if slot is None:
+			return default
+		return self.VALUES[slot]
+
+	# Every key and value. Shared between readers, so don't modify it
+	def snapshot(self):
+		snapshot = self.cache
+		if snapshot is None:
+			with self.LOCK:
+				snapshot = self.publish()
+		return snapshot
+
+	# Build the snapshot if it's gone stale, call with LOCK held
+	def publish(self):
+		if self.cache is None:
+			self.cache = dict(zip(self.KEYS, self.VALUES))
+		return self.cache
+
+	# (current version, {key : value} for every key changed after version). 0 gets everything
+	def changedSince(self, version):
+		with self.LOCK:
+			versions = self.VERSIONS
+			return self.version, dict((self.KEYS[slot], self.VALUES[slot]) for slot in range(len(versions)) if versions[slot] > version)
+
+	# Call listener(key, value) for every change from here on, with the lock held so it must not block.
+	# Returns the snapshot it follows on from, nothing is missed in between
+	def watch(self, listener):
+		with self.LOCK:
+			self.LISTENERS.append(listener)
+			return self.publish()
+
+	def unwatch(self, listener):
+		with self.LOCK:
+			if listener in self.LISTENERS:
+				self.LISTENERS.remove(listener)
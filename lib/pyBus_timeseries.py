@@ -0,0 +1,129 @@
+############################################################################
+# PYBUS TIME SERIES
+# RECENT HISTORY OF NUMERIC SESSION VALUES (SPEED, RPM, TEMPERATURES...), KEPT IN MEMORY
+# AT SEVERAL RESOLUTIONS SO A DRIVE CAN BE CHARTED WITHOUT MDROID-CORE
+#
+# Every series is a set of fixed capacity rings of typed arrays (8 byte timestamp + 8 byte value per point),
+# so memory stays bounded however long pyBus runs: at most MAX_KEYS * (sum of capacities) * 16 bytes.
+############################################################################
+
+import time
+import array
+import threading
+
+#####################################
+# CONFIG
+#####################################
+# (name, seconds averaged into each point, points kept). A step of 0 keeps every value as it arrives
+RESOLUTIONS = (
+	("raw", 0, 3600), # about 2 hours of SPEED / RPM, which come every 2 seconds
+	("10s", 10, 4320), # 12 hours
+	("1min", 60, 10080) # a week
+)
+MAX_KEYS = 32 # series kept, values for any further keys are ignored. 0 turns the store off
+
+#------------------------------------
+# CLASS for a fixed capacity ring of (timestamp, value) points
+# Fills up by appending, then overwrites the oldest point, so TIMES / VALUES never grow past capacity.
+#------------------------------------
+class ibusRing ( object ):
+	__slots__ = ('CAPACITY', 'TIMES', 'VALUES', 'next')
+
+	def __init__(self, capacity):
+		self.CAPACITY = max(int(capacity), 1)
+		self.TIMES = array.array('d')
+		self.VALUES = array.array('d')
+		self.next = 0 # where the next point goes once full, i.e. the oldest point
+
+	def add(self, timestamp, value):
+		if len(self.TIMES) < self.CAPACITY:
+			self.TIMES.append(timestamp)
+			self.VALUES.append(value)
+			return
+		self.TIMES[self.next] = timestamp
+		self.VALUES[self.next] = value
+		self.next = (self.next + 1) % self.CAPACITY
+
+	def __len__(self):
+		return len(self.TIMES)
+
+	# [(timestamp, value)] from start to end inclusive, oldest first.
+	# Points are checked one by one rather than bisected, as the ring is only in time order while the system clock
+	# only moves forward. A Pi has no RTC, so NTP can step it (either way) well after points have been recorded
+	def window(self, start=None, end=None):
+		times = self.TIMES[self.next:] + self.TIMES[:self.next]
+		values = self.VALUES[self.next:] + self.VALUES[:self.next]
+		return [(t, v) for t, v in zip(times, values) if (start is None or t >= start) and (end is None or t <= end)]
+
+#------------------------------------
+# CLASS for the history of one key at every resolution
+# Downsampled points are the mean of the values in their step, stamped with the start of it.
+# The step still being filled is included at the end of a window.
+#------------------------------------
+class ibusSeries ( object ):
+	def __init__(self, resolutions=RESOLUTIONS):
+		self.RINGS = dict()
+		self.BUCKETS = [] # [ring, step, start of the step being filled, sum, count] per downsampled resolution
+		self.RAW = []
+		for name, step, capacity in resolutions:
+			ring = self.RINGS[name] = ibusRing(capacity)
+			if step:
+				self.BUCKETS.append([ring, step, None, 0.0, 0])
+			else:
+				self.RAW.append(ring)
+
+	def add(self, timestamp, value):
+		for ring in self.RAW:
+			ring.add(timestamp, value)
+
+		for bucket in self.BUCKETS:
+			ring, step, start = bucket[0], bucket[1], bucket[2]
+			current = timestamp - timestamp % step
+			if current != start:
+				if bucket[4]:
+					ring.add(start, bucket[3] / bucket[4])
+				bucket[2], bucket[3], bucket[4] = current, 0.0, 0
+			bucket[3] += value
+			bucket[4] += 1
+
+	def window(self, resolution, start=None, end=None):
+		ring = self.RINGS[resolution]
+		points = ring.window(start, end)
+		for bucket in self.BUCKETS:
+			if bucket[0] is ring and bucket[4] and (start is None or bucket[2] >= start) and (end is None or bucket[2] <= end):
+				points.append((float(bucket[2]), bucket[3] / bucket[4]))
+		return points
+
+#------------------------------------
+# CLASS for every series, fed with numeric session updates by ibusSession.updateData
+#------------------------------------
+class ibusTimeSeries ( object ):
+	def __init__(self, maxKeys=MAX_KEYS, resolutions=RESOLUTIONS):
+		self.MAX_KEYS = int(maxKeys)
+		self.RESOLUTIONS = tuple(resolutions)
+		self.SERIES = dict() # key : ibusSeries
+		self.LOCK = threading.Lock()
+
+	def add(self, key, value, timestamp=None):
+		if timestamp is None:
+			timestamp = time.time()
+		with self.LOCK:
+			series = self.SERIES.get(key)
+			if series is None:
+				if len(self.SERIES) >= self.MAX_KEYS:
+					return
+				series = self.SERIES[key] = ibusSeries(self.RESOLUTIONS)
+			series.add(timestamp, float(value))
+
+	def keys(self):
+		with self.LOCK:
+			return sorted(self.SERIES)
+
+	def resolutions(self):
+		return [name for name, step, capacity in self.RESOLUTIONS]
+
+	# [(timestamp, value)] for a key between start and end (seconds since the epoch, None for no limit).
+	# Raises KeyError for a key or resolution that isn't kept
+	def window(self, key, resolution="raw", start=None, end=None):
+		with self.LOCK:
+			return self.SERIES[key].window(resolution, start, end)
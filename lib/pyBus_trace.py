@@ -0,0 +1,88 @@
+############################################################################
+# PYBUS TRACE
+# FIXED SIZE IN-MEMORY RECORD OF RECENT BUS EVENTS (FRAMES READ, WRITTEN, DROPPED, DISPATCHED)
+#
+# Recording an event only stores a tuple of references, nothing is formatted until the trace is read,
+# so it can stay on in the car. Read it over HTTP at /trace, or from the dump written on a crash.
+############################################################################
+
+import time
+import logging
+import itertools
+
+#####################################
+# CONFIG
+#####################################
+TRACE_SIZE = 4096 # events kept, older ones are overwritten. 0 turns tracing off
+DUMP_PATH = "/var/tmp/pyBus_trace.txt" # where the trace is written if pyBus dies
+
+# Event kinds
+READ = "READ" # frame read, subject is the ibusPacket
+BAD_CHECKSUM = "BAD_CHECKSUM" # frame failing the XOR check, subject is the raw frame
+BAD_LENGTH = "BAD_LENGTH" # impossible length byte, detail is the length
+DISPATCH = "DISPATCH" # packet handed to a directive, subject is the ibusPacket, detail the directive name
+WRITE_QUEUED = "WRITE_QUEUED" # frame queued for the transmit thread, subject is the raw frame
+WRITE_BUSY = "WRITE_BUSY" # adapter held CTS down, transmit is waiting
+WRITE = "WRITE" # frame left the port, detail is how long it waited in seconds
+WRITE_FAILED = "WRITE_FAILED" # frame couldn't be sent, detail is the error
+PORT_LOST = "PORT_LOST" # adapter went away, detail is the error
+PORT_BACK = "PORT_BACK" # adapter came back and its port was reopened, detail is the device path
+
+#------------------------------------
+# CLASS for the trace ring
+# Slots are claimed through itertools.count, which is atomic under the GIL, so recording needs no lock.
+#------------------------------------
+class ibusTrace ( ):
+	def __init__(self, size=TRACE_SIZE):
+		self.SIZE = max(int(size), 0)
+		self.EVENTS = [None] * self.SIZE
+		self.COUNTER = itertools.count()
+
+	def record(self, kind, subject=None, detail=None):
+		if self.SIZE:
+			index = next(self.COUNTER)
+			self.EVENTS[index % self.SIZE] = (time.time(), index, kind, subject, detail)
+
+	# Events oldest first, only the latest limit of them if given. Ordered by index rather than timestamp,
+	# as the system clock can be stepped (NTP setting it after boot, a Pi has no RTC) while we're recording
+	def events(self, limit=None):
+		events = sorted((event for event in list(self.EVENTS) if event), key=lambda event: event[1])
+		if limit:
+			events = events[-limit:]
+		return events
+
+	# Human readable trace, one event per line. names maps hex addresses to module names, e.g. pyBus_interface.LOCATIONS
+	def render(self, names=None, limit=None):
+		return "\n".join(formatEvent(event, names or {}) for event in self.events(limit)) + "\n"
+
+	# Write the trace to a file, e.g. on the way down after a crash
+	def dump(self, path=DUMP_PATH, names=None):
+		try:
+			with open(path, "w") as trace:
+				trace.write(self.render(names))
+			logging.info("Wrote bus trace to {}".format(path))
+		except (IOError, OSError), e:
+			logging.error("Failed to write bus trace to {}: {}".format(path, e))
+
+def formatFrame(frame, names):
+	src, dst = '%02X' % frame[0], '%02X' % frame[2]
+	return "[{} -> {}] {}".format(names.get(src, src), names.get(dst, dst), " ".join('%02X' % b for b in frame))
+
+def formatEvent(event, names):
+	timestamp, index, kind, subject, detail = event
+	line = "{}.{:06d} {:<13}".format(time.strftime("%H:%M:%S", time.localtime(timestamp)), int(timestamp % 1 * 1e6), kind)
+	if subject is not None:
+		frame = bytearray(subject.toBytes()) if hasattr(subject, "toBytes") else bytearray(subject)
+		line += " " + (formatFrame(frame, names) if len(frame) >= 3 else repr(subject))
+	if detail is not None:
+		line += " ({})".format(detail)
+	return line
+
+# The trace everything records into, replaced by configure()
+TRACE = ibusTrace()
+
+# Rebuild the trace with a new size, call before anything starts recording
+def configure(size=TRACE_SIZE):
+	global TRACE
+	TRACE = ibusTrace(size)
+	return TRACE
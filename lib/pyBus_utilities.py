@@ -6,7 +6,7 @@
 # TYPICALLY DIRECTIVES ARE REACTIVE, THESE UTLITIES ARE ACTIVE
 ############################################################################
 
-import requests
+import pyBus_http as pB_http
 import pyBus_eventDriver as main
 import pyBus_directives as directives
 
@@ -243,7 +243,7 @@ def hex2bin(hexi):
 # Send command / request
 def sendRequest(fetchURL):
 	try:
-		main.logging.debug(requests.get(fetchURL))
+		main.logging.debug(pB_http.CLIENT.get(fetchURL))
 	except Exception, e:
 		main.logging.debug("Failed to send GET request to "+fetchURL)
 		main.logging.debug(e)
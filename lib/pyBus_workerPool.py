@@ -0,0 +1,104 @@
+############################################################################
+# PYBUS WORKER POOL
+# RUNS DIRECTIVES OFF THE READER THREAD, SO NETWORK CALLS CAN'T STALL THE BUS
+############################################################################
+
+import logging
+import threading
+import Queue
+import pyBus_metrics as pB_metrics
+
+#####################################
+# CONFIG
+#####################################
+WORKERS = 2 # threads running directives
+QUEUE_DEPTH = 64 # jobs waiting per worker before the drop policy kicks in
+
+# What to do when a worker's queue is full
+DROP_OLDEST = "oldest" # throw away the oldest waiting job, the newest packet is usually the one that matters
+DROP_NEWEST = "newest" # throw away the job being submitted
+BLOCK = "block" # make the reader wait, never drops anything
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+#------------------------------------
+# CLASS for a bounded pool of directive workers
+# Every job has a key (the packet's (bus, src, dst)) and all jobs with the same key go to the same worker,
+# so packets from one stream are handled in the order they were read, while different streams run in parallel.
+#------------------------------------
+class ibusWorkerPool ( ):
+	def __init__(self, workers=WORKERS, depth=QUEUE_DEPTH, policy=DROP_OLDEST):
+		if policy not in DROP_POLICIES:
+			logging.warning("Unknown drop policy (%s), using '%s'" % (policy, DROP_OLDEST))
+			policy = DROP_OLDEST
+
+		self.POLICY = policy
+		self.QUEUES = [Queue.Queue(max(depth, 1)) for i in range(max(workers, 1))]
+		self.THREADS = []
+		self.dropped = 0
+
+		for index, queue in enumerate(self.QUEUES):
+			thread = threading.Thread(target=self.work, args=(queue,), name="directiveWorker-%d" % index)
+			thread.daemon = True
+			thread.start()
+			self.THREADS.append(thread)
+
+		pB_metrics.collect("pybus_directive_queue_depth", "Directives waiting on each worker", "gauge",
+			lambda: dict(enumerate(self.getDepths())), "worker")
+		pB_metrics.collect("pybus_directive_dropped_total", "Directives dropped because their worker's queue was full", "counter",
+			lambda: self.dropped)
+
+	# Queue func(*args) on the worker owning this key. Returns False if a job was dropped to make it fit
+	def submit(self, key, func, *args):
+		queue = self.QUEUES[hash(key) % len(self.QUEUES)]
+		job = (func, args)
+
+		if self.POLICY == BLOCK:
+			queue.put(job)
+			return True
+
+		try:
+			queue.put_nowait(job)
+			return True
+		except Queue.Full:
+			pass
+
+		self.dropped += 1
+		if self.POLICY == DROP_NEWEST:
+			logging.warning("Directive queue for %s full, dropping newest job" % (key,))
+			return False
+
+		try:
+			queue.get_nowait()
+			queue.task_done()
+			logging.warning("Directive queue for %s full, dropping oldest job" % (key,))
+		except Queue.Empty:
+			pass
+		try:
+			queue.put_nowait(job)
+		except Queue.Full:
+			logging.warning("Directive queue for %s full, dropping newest job" % (key,))
+		return False
+
+	def work(self, queue):
+		while True:
+			job = queue.get()
+			try:
+				if job is None:
+					return
+				func, args = job
+				func(*args)
+			except Exception, e:
+				logging.error("Exception raised in directive worker: %s" % e)
+			finally:
+				queue.task_done()
+
+	# Jobs currently waiting on each worker
+	def getDepths(self):
+		return [queue.qsize() for queue in self.QUEUES]
+
+	# Stop the workers once they've finished what's already queued
+	def shutDown(self, timeout=2):
+		for queue in self.QUEUES:
+			queue.put(None)
+		for thread in self.THREADS:
+			thread.join(timeout)
@@ -9,12 +9,13 @@ import logging
 import argparse
 import gzip
 import json
+import collections
 import pyBus_core as core
 
 #####################################
 # FUNCTIONS
 #####################################
-# Manage Ctrl+C gracefully
+# Manage Ctrl+C (and being stopped as a service) gracefully
 def signal_handler_quit(signal, frame):
 	logging.info("Shutting down pyBus.")
 	core.shutdown()
@@ -41,6 +42,8 @@ def createParser():
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-v', '--verbose', action='store', default=20, type=int, help='Increases verbosity of logging.')
 	parser.add_argument('--settings-file', action='store', help='Config file to load Device and API settings.')
+	parser.add_argument('--replay', action='store', help='Play a capture file or log of READ lines through pyBus instead of reading the device.')
+	parser.add_argument('--replay-speed', action='store', default=1, type=float, help='Replay speed multiplier, 0 to replay as fast as possible.')
 	return parser
 
 #####################################
@@ -52,6 +55,7 @@ loglevel = args.verbose
 _startup_cwd = os.getcwd()
 
 signal.signal(signal.SIGINT, signal_handler_quit) # Manage Ctrl+C
+signal.signal(signal.SIGTERM, signal_handler_quit) # systemctl stop
 configureLogging(loglevel)
 
 devPath = "/dev/ttyUSB0"
@@ -64,7 +68,7 @@ if args.settings_file:
 	if os.path.isfile(args.settings_file): 
 		try:
 			with open(args.settings_file) as json_file:
-				data = json.load(json_file)
+				data = json.load(json_file, object_pairs_hook=collections.OrderedDict) # keeps BUSES in the order given
 				if "MDROID" in data:
 					# Setup MDroid API
 					if "MDROID_HOST" in data["MDROID"]:
@@ -79,12 +83,21 @@ if args.settings_file:
 					else: 
 						logging.debug("PYBUS_DEVICE not found in config file, using defaults.")
 
+				# Tuning for pyBus itself, keys are passed through lower cased (e.g. WORKERS -> workers)
+				if "PYBUS" in data:
+					for key, value in data["PYBUS"].items():
+						config[key.lower()] = value
+
 		except IOError as e:
 			logging.error("Failed to open settings file:"+args.settings_file)
 			logging.error(e)
 	else:
 		logging.error("Could not load settings from file"+str(args.settings_file))
 
+if args.replay:
+	config["replay"] = args.replay
+	config["replay_speed"] = args.replay_speed
+
 # Make requests a little quieter
 logging.getLogger("requests").setLevel(logging.ERROR)
 
@@ -93,5 +106,6 @@ try:
 	core.run()
 except Exception:
 	logging.error("Caught unexpected exception:\n{}".format(traceback.format_exc()))
+	core.dumpTrace()
 	logging.critical("And I'm dead.")    
 	sys.exit(0)
@@ -0,0 +1,434 @@
+#!/usr/bin/python
+
+import os
+import sys
+import gc
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import threading
+import subprocess
+
+try:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+except ImportError:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+
+sys.path.append( './lib/' )
+
+import pyBus_eventDriver as pB_eDriver
+import pyBus_directives as directives
+import pyBus_session as pB_session
+import pyBus_trace as pB_trace
+import pyBus_http as pB_http
+from pyBus_interface import ibusFace, ibusPacket, xorChecksum
+
+# Benchmarks the receive and dispatch hot path on synthetic traffic, no car or USB interface needed:
+#   parse          ibusFace.readBusPacket through the ring buffer, from a port with the whole mix waiting
+#   parse_legacy   the same through the old one readChar() at a time path
+#   dispatch       pyBus_eventDriver.manage, i.e. finding the directive and handing it to the worker pool
+#   decode_ike     d_custom_IKE on the mix's IKE broadcasts
+#   decode_door    d_windowDoorMessage on the mix's door / window status
+#   session        ibusSession.updateData for everything the mix decodes to, uploading to a local stand-in for MDroid-Core
+# Each stage reports frames (or updates) per second, per call latency percentiles and the net number of gc tracked
+# objects it keeps alive per call. Python 2 has no way to count allocations, so those aren't measured.
+# Results are kept per version in bench_results/, and compared against the last run of a different version.
+
+#####################################
+# CONFIG
+#####################################
+FRAMES = 20000 # frames generated per traffic mix
+SEED = 1 # traffic is random, but the same every run
+OUTPUT_DIR = "bench_results"
+REGRESSION = 0.10 # a drop in throughput past this fraction is flagged
+PERCENTILES = (50, 90, 99)
+
+#####################################
+# SYNTHETIC TRAFFIC
+#####################################
+def frame(src, dst, dat):
+	data = bytearray([src, len(dat) + 2, dst]) + bytearray(dat)
+	data.append(xorChecksum(data))
+	return data
+
+RADIO_TEXT = ["FM 101.1", "BAYERN 3", "NOW PLAYING", "TR 04 02:31", "CD 1-04", "SCAN", "TP TRAFFIC", "ANTENNE"]
+
+# Each generator takes the random source and returns one frame
+TRAFFIC = {
+	"ike_speed" : lambda r: frame(0x80, 0xBF, [0x18, r.randint(0, 120), r.randint(7, 60)]),
+	"ike_temp" : lambda r: frame(0x80, 0xBF, [0x19, r.randint(10, 30), r.randint(70, 100), 0x00]),
+	"ike_sensor" : lambda r: frame(0x80, 0xBF, [0x13, 0x03, 0x00, 0x00, 0x00, 0x00, 0x00, r.choice([0x14, 0x15])]),
+	"ike_ignition" : lambda r: frame(0x80, 0xBF, [0x11, r.choice([0x00, 0x01, 0x03])]),
+	"ike_range" : lambda r: frame(0x80, 0xBF, [0x24, 0x06, 0x00] + [ord(c) for c in "%04d" % r.randint(100, 600)]),
+	"door" : lambda r: frame(0x00, 0xBF, [0x7A, r.choice([0x10, 0x20, 0x21, 0x22]), r.choice([0x00, 0x01, 0x40])]),
+	"lights" : lambda r: frame(0xD0, 0xBF, [0x5B, 0x61, 0x00, 0x04, 0x00, 0x01]),
+	"climate" : lambda r: frame(0x5B, 0x80, r.choice([[0x83, 0x00, 0x00], [0x83, 0x80, 0x08], [0x83, 0x80, 0x04]])),
+	"rain" : lambda r: frame(0xE8, 0xD0, [0x59, r.choice([0x11, 0x20]), r.choice([0x01, 0x02, 0x04])]),
+	"steering" : lambda r: frame(0x50, 0x68, [0x3B, r.choice([0x01, 0x21, 0x08, 0x28])]),
+	"cd_poll" : lambda r: frame(0x68, 0x18, [0x01]),
+	"cd_status" : lambda r: frame(0x68, 0x18, [0x38, 0x00, 0x00]),
+	"radio_text" : lambda r: frame(0x68, 0x3B, [0x23, 0x62, 0x30] + [ord(c) for c in r.choice(RADIO_TEXT)])
+}
+
+# Relative weights of each kind of frame in a mix
+MIXES = {
+	# Parked with the ignition on, mostly periodic status broadcasts
+	"idle" : {"ike_sensor" : 3, "ike_temp" : 3, "ike_ignition" : 1, "lights" : 2, "door" : 1, "cd_poll" : 2},
+	# Speed / RPM every couple of seconds plus everything a moving car chatters about
+	"driving" : {"ike_speed" : 10, "ike_temp" : 2, "ike_sensor" : 1, "ike_range" : 1, "climate" : 2, "rain" : 2, "steering" : 1, "door" : 1, "radio_text" : 2},
+	# The radio repainting its display, long frames nothing is listening for
+	"radio" : {"radio_text" : 12, "cd_status" : 2, "ike_speed" : 2, "climate" : 1, "door" : 1}
+}
+
+def generateMix(name, count, seed=SEED):
+	r = random.Random("{}:{}".format(seed, name))
+	kinds = []
+	for kind, weight in sorted(MIXES[name].items()):
+		kinds.extend([kind] * weight)
+	return [TRAFFIC[r.choice(kinds)](r) for i in range(count)]
+
+#####################################
+# STAND-INS
+#####################################
+#------------------------------------
+# CLASS standing in for the serial port, with a whole mix already waiting on it
+#------------------------------------
+class benchSerial ( ):
+	def __init__(self, data):
+		self.DATA = bytes(data)
+		self.position = 0
+
+	@property
+	def in_waiting(self):
+		return len(self.DATA) - self.position
+
+	def read(self, size=1):
+		data = self.DATA[self.position:self.position + size]
+		self.position += len(data)
+		return data
+
+	def write(self, data):
+		return len(data)
+
+	def flush(self):
+		pass
+
+	def flushInput(self):
+		pass
+
+	def setDTR(self, value=True):
+		pass
+
+	def getCTS(self):
+		return True
+
+	def close(self):
+		pass
+
+#------------------------------------
+# CLASS standing in for the worker pool, so dispatch is timed without running the directives
+#------------------------------------
+class benchWorkers ( ):
+	def __init__(self):
+		self.submitted = 0
+
+	def submit(self, key, func, *args):
+		self.submitted += 1
+		return True
+
+	def shutDown(self, timeout=2):
+		pass
+
+#------------------------------------
+# CLASS collecting what directives would write to the session, so the session stage replays the mix's real updates
+#------------------------------------
+class benchRecorder ( ):
+	def __init__(self):
+		self.data = dict()
+		self.updates = []
+
+	def updateData(self, key, data):
+		self.data[key] = data
+		self.updates.append((key, data))
+
+	def get(self, key, default=None):
+		return self.data.get(key, default)
+
+# MDroid-Core stand-in, answers every session POST and counts what it got
+class benchApiHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+		with self.server.LOCK:
+			self.server.requests += 1
+			if self.path.rstrip("/") == "/session":
+				self.server.updates += len(json.loads(body))
+			else:
+				self.server.updates += 1
+		self.send_response(200)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+	def log_message(self, format, *args):
+		pass
+
+class benchApiServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+	def __init__(self):
+		HTTPServer.__init__(self, ("127.0.0.1", 0), benchApiHandler)
+		self.LOCK = threading.Lock()
+		self.requests = 0
+		self.updates = 0
+		self.THREAD = threading.Thread(target=self.serve_forever, name="benchApi")
+		self.THREAD.daemon = True
+		self.THREAD.start()
+
+	def url(self):
+		return "http://127.0.0.1:{}".format(self.server_address[1])
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+#####################################
+# STAGES
+# Each takes the mix and returns (calls, step, finish): step() does one unit of work and is called
+# 'calls' times, finish() cleans up and returns any extra figures for the report
+#####################################
+def routedTo(frames, name):
+	matched = []
+	for data in frames:
+		route = pB_eDriver.DISPATCH.get((data[0], data[2]))
+		if route:
+			method = route.match(data[3:-1])
+			if method and method.__name__ == name:
+				matched.append(data)
+	return matched
+
+def stageParse(frames, buffered=True):
+	face = ibusFace("bench", buffered=buffered, device=benchSerial(b"".join(bytes(data) for data in frames)))
+
+	def finish():
+		stats = face.getStats()
+		face.close()
+		return {"bad_frames" : stats["bad_length"] + stats["bad_checksum"] + stats["stale"]}
+	return len(frames), face.readBusPacket, finish
+
+def stageParseLegacy(frames):
+	return stageParse(frames, buffered=False)
+
+def stageDispatch(frames):
+	packets = iter(map(packetOf, frames))
+	workers = benchWorkers()
+	pB_eDriver.WORKERS = workers
+
+	def finish():
+		pB_eDriver.WORKERS = None
+		return {"dispatched" : workers.submitted}
+	return len(frames), lambda: pB_eDriver.manage(next(packets)), finish
+
+def stageDecoder(name):
+	def stage(frames):
+		packets = map(packetOf, routedTo(frames, name))
+		directive = getattr(directives, name)
+		pB_eDriver.SESSION = pB_session.ibusSession(False)
+		items = iter(packets)
+		return len(packets), lambda: directive(next(items)), lambda: {}
+	return stage
+
+def stageSession(frames):
+	# Everything the mix decodes to, in order
+	recorder = benchRecorder()
+	pB_eDriver.SESSION = recorder
+	for data in frames:
+		route = pB_eDriver.DISPATCH.get((data[0], data[2]))
+		method = route.match(data[3:-1]) if route else None
+		if method:
+			pB_eDriver.runDirective(method, packetOf(data))
+
+	server = benchApiServer()
+	session = pB_session.ibusSession(server.url(), spoolPath=None)
+	updates = iter(recorder.updates)
+
+	def step():
+		key, value = next(updates)
+		session.updateData(key, value)
+
+	def finish():
+		started = time.time()
+		session.close() # waits for the uploader to send what's left
+		drain = time.time() - started
+		pB_http.CLIENT.close() # hang up the kept-alive connections, or the stand-in's handlers wait on them until exit
+		server.stop()
+		return {"requests" : server.requests, "uploaded" : server.updates, "drain_ms" : round(drain * 1000, 1)}
+	return len(recorder.updates), step, finish
+
+def packetOf(data):
+	return ibusPacket.fromFrame(data)
+
+STAGES = [
+	("parse", stageParse),
+	("parse_legacy", stageParseLegacy),
+	("dispatch", stageDispatch),
+	("decode_ike", stageDecoder("d_custom_IKE")),
+	("decode_door", stageDecoder("d_windowDoorMessage")),
+	("session", stageSession)
+]
+
+#####################################
+# MEASUREMENT
+#####################################
+def percentile(ordered, p):
+	if not ordered:
+		return 0
+	return ordered[int(round(p / 100.0 * (len(ordered) - 1)))]
+
+# Time every call, then run the stage again to count retained objects (kept apart so counting doesn't skew the timing)
+def runStage(stage, frames):
+	calls, step, finish = stage(frames)
+	if not calls:
+		finish()
+		return None
+
+	latencies = [0.0] * calls
+	clock = time.time
+	started = clock()
+	for i in xrange(calls):
+		before = clock()
+		step()
+		latencies[i] = clock() - before
+	elapsed = clock() - started
+	extra = finish()
+
+	latencies.sort()
+	result = {
+		"calls" : calls,
+		"per_second" : round(calls / max(elapsed, 1e-9), 1),
+		"mean_us" : round(sum(latencies) / calls * 1e6, 2),
+		"max_us" : round(latencies[-1] * 1e6, 2)
+	}
+	for p in PERCENTILES:
+		result["p{}_us".format(p)] = round(percentile(latencies, p) * 1e6, 2)
+	result.update(countRetained(stage, frames))
+	result.update(extra)
+	return result
+
+# Net gc tracked objects still alive per call once the stage is done, i.e. what it holds on to, not what it allocates.
+# Tracing is off for this run, otherwise the trace ring holding on to recent packets is what gets counted
+def countRetained(stage, frames):
+	trace, pB_trace.TRACE = pB_trace.TRACE, pB_trace.ibusTrace(0)
+	try:
+		calls, step, finish = stage(frames)
+		try:
+			gc.collect()
+			objects = len(gc.get_objects())
+			for i in xrange(calls):
+				step()
+			gc.collect()
+			return {"retained_per_call" : round((len(gc.get_objects()) - objects) / float(calls), 3)}
+		finally:
+			finish()
+	finally:
+		pB_trace.TRACE = trace
+
+def runMix(name, count, seed):
+	frames = generateMix(name, count, seed)
+	results = dict()
+	for stageName, stage in STAGES:
+		result = runStage(stage, frames)
+		if result:
+			results[stageName] = result
+	return results
+
+#####################################
+# RESULTS
+#####################################
+# Name results are stored under, the git commit unless told otherwise
+def versionLabel():
+	try:
+		return subprocess.check_output(["git", "describe", "--always", "--dirty"], stderr=open(os.devnull, "w")).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return "unknown"
+
+# Most recent run of any other version
+def loadPrevious(directory, label):
+	previous = []
+	for name in os.listdir(directory):
+		if name.endswith(".json") and name != label + ".json":
+			path = os.path.join(directory, name)
+			previous.append((os.path.getmtime(path), path))
+	if not previous:
+		return None
+	with open(max(previous)[1]) as results:
+		return json.load(results)
+
+def report(run, previous):
+	print "pyBus benchmark {} ({}, {} frames per mix)".format(run["label"], run["python"], run["frames"])
+	print "Last column is the net number of gc tracked objects kept alive per call, allocations aren't measured"
+	if previous:
+		print "Compared against {}".format(previous["label"])
+
+	for mix in sorted(run["results"]):
+		print
+		print "[{}]".format(mix)
+		print "  {:<14}{:>8}{:>13}{:>10}{:>10}{:>10}{:>10}{:>25}".format("stage", "calls", "per sec", "p50 us", "p90 us", "p99 us", "max us", "net retained gc objects")
+		for stage, unused in STAGES:
+			result = run["results"][mix].get(stage)
+			if not result:
+				continue
+			line = "  {:<14}{:>8}{:>13.0f}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>25.3f}".format(stage, result["calls"], result["per_second"],
+				result["p50_us"], result["p90_us"], result["p99_us"], result["max_us"], result["retained_per_call"])
+
+			before = previous and previous["results"].get(mix, {}).get(stage)
+			if before:
+				change = (result["per_second"] - before["per_second"]) / before["per_second"]
+				line += "  {:+.1%}".format(change)
+				if change < -REGRESSION:
+					line += " REGRESSION"
+			print line
+
+def createParser():
+	parser = argparse.ArgumentParser(description="Benchmark the pyBus receive and dispatch path on synthetic traffic.")
+	parser.add_argument('--frames', action='store', default=FRAMES, type=int, help='Frames generated per traffic mix.')
+	parser.add_argument('--mix', action='append', choices=sorted(MIXES), help='Traffic mix to run, repeat for several. Default is all of them.')
+	parser.add_argument('--seed', action='store', default=SEED, type=int, help='Seed for the synthetic traffic.')
+	parser.add_argument('--label', action='store', help='Name to store results under, defaults to the git version.')
+	parser.add_argument('--output-dir', action='store', default=OUTPUT_DIR, help='Directory results are kept in.')
+	return parser
+
+def main():
+	args = createParser().parse_args()
+	logging.basicConfig(level=logging.WARNING) # the hot path logs at info, that shouldn't be what's measured
+
+	# Dispatch table as the event driver builds it, without the side effects of init()
+	pB_eDriver.DISPATCH = directives.compileDirectives()
+	pB_eDriver.WORKERS = None
+
+	run = {
+		"label" : args.label or versionLabel(),
+		"time" : time.strftime("%Y-%m-%d %H:%M:%S"),
+		"python" : platform.python_version(),
+		"frames" : args.frames,
+		"seed" : args.seed,
+		"results" : dict()
+	}
+	for mix in args.mix or sorted(MIXES):
+		run["results"][mix] = runMix(mix, args.frames, args.seed)
+
+	if not os.path.isdir(args.output_dir):
+		os.makedirs(args.output_dir)
+	previous = loadPrevious(args.output_dir, run["label"])
+	with open(os.path.join(args.output_dir, run["label"] + ".json"), "w") as results:
+		json.dump(run, results, indent=2, sort_keys=True)
+
+	report(run, previous)
+
+if __name__ == "__main__":
+	main()
@@ -9,8 +9,11 @@ import logging
 import binascii
 import subprocess
 from time import strftime as date
+import Queue
+import socket
 import threading
 from urllib import unquote
+from urlparse import parse_qs
 
 from BaseHTTPServer import BaseHTTPRequestHandler
 
@@ -20,43 +23,87 @@ except ImportError:
     from http.server import SimpleHTTPRequestHandler
 
 try:
-    from SocketServer import TCPServer as HTTPServer
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
 except ImportError:
     from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
 
 sys.path.append( './lib/' )
 
 import pyBus_eventDriver as pB_eDriver # For responding to signals
 
-from pyBus_interface import ibusFace
+import pyBus_capture as pB_capture # Binary capture of bus traffic
+import pyBus_replay as pB_replay # Stand-in serial port playing back recorded traffic
+import pyBus_metrics as pB_metrics # Counters and histograms for /metrics
+import pyBus_trace as pB_trace # In-memory trace of recent bus events
+import pyBus_buses as pB_buses # Several interfaces read from one thread
+import pyBus_hotplug as pB_hotplug # Notices the USB adapter being plugged in
+
+from pyBus_interface import ibusFace, LOCATIONS, TX_HOLD
 #####################################
 # GLOBALS
 #####################################
 DEVPATH           = "/dev/ttyUSB0" # This is a default, but its always overridden. So not really a default.
-IBUS              = None
+DEFAULT_BUS       = "IBUS" # id of the bus on DEVPATH when no BUSES are configured
+IBUS              = None # pB_buses.ibusBuses over every interface opened
+LISTENER          = None # thread running pB_eDriver.listen
+LISTENER_STOP_TIMEOUT = 2 # seconds shutdown waits for the listener to notice it should stop
+REPLAY            = None # replaySerial standing in for the port when replaying a recording
 PORT_NUMBER 	  = 8080
+STREAM_KEEPALIVE  = 15 # seconds between keep-alive comments on an idle /session/stream
 
 #####################################
 # FUNCTIONS
 
 # Initializes modules as required and opens files for writing
 def initialize(args):
-	global IBUS, DEVPATH
+	global IBUS, DEVPATH, REPLAY
 	
-	# Initialize the iBus interface or wait for it to become available.
-	while IBUS == None:
-		if os.path.exists(DEVPATH):
-			IBUS = ibusFace(DEVPATH)
-		else:
-			logging.warning("USB interface not found at (%s). Waiting 1 seconds.", DEVPATH)
-			time.sleep(2)
-	IBUS.waitClearBus() # Wait for the iBus to clear, then send some initialization signals
+	# Trace of recent bus events, sized before anything starts recording
+	pB_trace.configure(int(args.get("trace_size", pB_trace.TRACE_SIZE)))
+
+	# Bus id : device path, in order, the first being the default for writes
+	buses = [(str(bus).upper(), path) for bus, path in (args.get("buses") or {DEFAULT_BUS : DEVPATH}).items()]
+
+	faces = []
+	if args.get("replay"):
+		# Play a capture or text log through the interface of the first bus instead of reading the car
+		REPLAY = pB_replay.replaySerial(args["replay"], speed=args.get("replay_speed", 1))
+		faces.append((buses[0][0], ibusFace(args["replay"], device=REPLAY, bus=buses[0][0])))
+		buses = []
+
+	# Initialize the iBus interfaces or wait for them to become available.
+	for bus, path in buses:
+		if not os.path.exists(path):
+			logging.warning("USB interface for %s not found at (%s). Waiting for it to be plugged in.", bus, path)
+			pB_hotplug.waitForDevice(path)
+		faces.append((bus, ibusFace(path, bus=bus, txHold=float(args.get("tx_hold", TX_HOLD)))))
+	IBUS = pB_buses.ibusBuses(faces)
+
+	if not REPLAY:
+		IBUS.waitClearBus() # Wait for the iBus to clear, then send some initialization signals
+
+	# Record raw bus traffic if asked to
+	if args.get("capture_dir"):
+		IBUS.startCapture(
+			args["capture_dir"],
+			maxBytes=args.get("capture_max_bytes", pB_capture.MAX_BYTES),
+			maxFiles=args.get("capture_max_files", pB_capture.MAX_FILES)
+		)
 	
 	pB_eDriver.init(IBUS, args)
 	
 # close the USB device and whatever else is required
 def shutdown():
 	global IBUS
+	dumpTrace()
+
+	# Stop reading before tearing down what the reader hands packets to
+	pB_eDriver.stopListening()
+	if LISTENER and LISTENER.is_alive() and LISTENER is not threading.current_thread():
+		LISTENER.join(LISTENER_STOP_TIMEOUT)
+
 	logging.info("Shutting down event driver")
 	pB_eDriver.shutDown()
 	
@@ -65,12 +112,19 @@ def shutdown():
 		IBUS.close()
 		IBUS = None
 
+# Write the trace of recent bus events to disk, for working out what happened after a crash
+def dumpTrace(path=pB_trace.DUMP_PATH):
+	pB_trace.TRACE.dump(path, LOCATIONS)
+
 def run():
-	# Open up HTTP server to listen on the network
+	global LISTENER
+	# Open up HTTP server to listen on the network, it lives as long as the bus is being read
 	serverThread = threading.Thread(target=startHTTPServer, args=(None,))
+	serverThread.daemon = True
 
-	# Start listening locally on serial bus
-	pybusThread = threading.Thread(target=pB_eDriver.listen, args=(None,))
+	# Start listening locally on serial bus. A daemon, so a read stuck on a dying port can't keep the process up after shutdown
+	pybusThread = LISTENER = threading.Thread(target=pB_eDriver.listen, args=(None,))
+	pybusThread.daemon = True
 
 	try:
 		pybusThread.start()
@@ -79,41 +133,197 @@ def run():
 		logging.error("Error: unable to start threads: %s" % e)
 		shutdown()
 
-	# Join threads
-	pybusThread.join()
-	serverThread.join()
+	# Join threads, listening only stops when a replay runs out or on shutdown. Joined in steps, as Python 2
+	# only runs signal handlers (Ctrl+C, SIGTERM) on the main thread once a blocking join returns
+	while pybusThread.is_alive():
+		pybusThread.join(0.5)
 
 	# Stop
+	stats = IBUS.getStats() if IBUS else {}
 	shutdown()
 
+	if REPLAY:
+		elapsed = time.time() - REPLAY.startTime
+		logging.info("Replay finished: {} frames through read -> manage -> session in {:.2f}s ({:.0f} frames/s)".format(
+			stats.get("frames", 0), elapsed, stats.get("frames", 0) / max(elapsed, 0.001)))
+		logging.info("Frame stats: {}".format(stats))
+
 # Additional HTTP server to recieve external messages
+# Speaks HTTP/1.1, so clients can keep one connection open for many requests
 class pybusServer(BaseHTTPRequestHandler):
-	
+	protocol_version = "HTTP/1.1"
+
 	# Handler for the GET requests
 	def do_GET(self):
 		try:
-			if self.path == "/":
-				self.send_response(200)
-				self.wfile.write("OK")
+			path = self.path.split("?")[0].rstrip("/")
+			if path == "":
+				self.sendResponse(200, "OK")
 				return
 
-			utilityResponse = pB_eDriver.handleExternalMessages(unquote(self.path).replace("/", ""))
+			# Local session, as a snapshot or a stream of changes
+			if path == "/session":
+				self.sendResponse(200, json.dumps(pB_eDriver.SESSION.snapshot() if pB_eDriver.SESSION else {}), "application/json")
+				return
+			# Keys changed since a version, ?since=N with the version from the last answer (0 for everything)
+			if path == "/session/changes":
+				self.sendChanges()
+				return
+			if path == "/session/stream":
+				self.streamSession()
+				return
+
+			# History of numeric values, see pyBus_timeseries
+			if path == "/series" or path.startswith("/series/"):
+				self.sendSeries(path[len("/series/"):])
+				return
+
+			# Prometheus scrape
+			if path == "/metrics":
+				self.sendResponse(200, pB_metrics.render(), "text/plain; version=0.0.4")
+				return
+
+			# Recent bus events, ?limit=N for only the latest N
+			if path == "/trace":
+				limit = parse_qs(self.path.partition("?")[2]).get("limit", [0])[0]
+				self.sendResponse(200, pB_trace.TRACE.render(LOCATIONS, int(limit)))
+				return
+
+			# ?bus=<id> sends anything the utility writes to that bus
+			bus = parse_qs(self.path.partition("?")[2]).get("bus", [None])[0]
+			utilityResponse = pB_eDriver.handleExternalMessages(unquote(path).replace("/", ""), bus and bus.upper())
 			if utilityResponse == "OK":
-				self.send_response(200)
-				self.end_headers()
-				self.wfile.write("OK")
+				self.sendResponse(200, "OK")
 			else:
-				self.send_error(404, 'Message does not match any known utilities: {}\n{}'.format(self.path, utilityResponse))
+				self.sendResponse(404, 'Message does not match any known utilities: {}\n{}'.format(self.path, utilityResponse))
 			return
 
 		except Exception, e:
-			self.send_error(404,'Error parsing utility: {}\n{}'.format(self.path, e))
+			self.sendResponse(404, 'Error parsing utility: {}\n{}'.format(self.path, e))
+
+	# Handler for the POST requests
+	# /batch takes a JSON list of utility names and/or raw packets ([src, dst, data]), runs them in order
+	# and answers with a JSON list of per item results
+	def do_POST(self):
+		try:
+			body = self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+			path, _, query = self.path.partition("?")
+			if path.rstrip("/") != "/batch":
+				self.sendResponse(404, 'Unknown endpoint: {}'.format(self.path))
+				return
+
+			items = json.loads(body)
+			if not isinstance(items, list):
+				self.sendResponse(400, 'Expected a JSON list of utilities / raw packets')
+				return
+
+			bus = parse_qs(query).get("bus", [None])[0]
+			self.sendResponse(200, json.dumps(pB_eDriver.handleBatch(items, bus and bus.upper())), "application/json")
+
+		except ValueError, e:
+			self.sendResponse(400, 'Error parsing batch: {}'.format(e))
+		except Exception, e:
+			self.sendResponse(500, 'Error running batch: {}'.format(e))
+
+	def sendChanges(self):
+		if not pB_eDriver.SESSION:
+			self.sendResponse(503, "Session not started")
+			return
+		since = parse_qs(self.path.partition("?")[2]).get("since", [0])[0]
+		version, changes = pB_eDriver.SESSION.changedSince(int(since))
+		self.sendResponse(200, json.dumps({"version" : version, "changes" : changes}), "application/json")
+
+	# /series lists the keys kept, /series/<KEY> returns their points as [[timestamp, value], ...], oldest first.
+	# ?resolution=raw|10s|1min (raw by default), then either ?last=<seconds> or ?since= / ?until= in seconds since the epoch
+	def sendSeries(self, key):
+		series = pB_eDriver.SERIES
+		if not series:
+			self.sendResponse(503, "Time series not kept")
+			return
+		if not key:
+			self.sendResponse(200, json.dumps({"keys" : series.keys(), "resolutions" : series.resolutions()}), "application/json")
+			return
+
+		query = dict((name, values[0]) for name, values in parse_qs(self.path.partition("?")[2]).items())
+		resolution = query.get("resolution", "raw")
+		if resolution not in series.resolutions():
+			self.sendResponse(400, "Unknown resolution {}, expected one of {}".format(resolution, ", ".join(series.resolutions())))
+			return
+
+		since, until = query.get("since"), query.get("until")
+		if query.get("last"):
+			since, until = time.time() - float(query["last"]), None
+		key = unquote(key).upper()
+		try:
+			points = series.window(key, resolution, since and float(since), until and float(until))
+		except KeyError:
+			self.sendResponse(404, "No series for {}".format(key))
+			return
+		self.sendResponse(200, json.dumps({"key" : key, "resolution" : resolution, "points" : points}), "application/json")
+
+	# Server-Sent Events stream of the session. The first event is the whole snapshot,
+	# after that each event only holds the keys that changed
+	def streamSession(self):
+		if not pB_eDriver.SESSION:
+			self.sendResponse(503, "Session not started")
+			return
+
+		snapshot, subscriber = pB_eDriver.SESSION.subscribe()
+		try:
+			self.close_connection = 1 # stream runs until the client goes away
+			self.send_response(200)
+			self.send_header("Content-Type", "text/event-stream")
+			self.send_header("Cache-Control", "no-cache")
+			self.send_header("Connection", "close")
+			self.end_headers()
+			self.wfile.write("data: {}\n\n".format(json.dumps(snapshot)))
+			self.wfile.flush()
+
+			while True:
+				try:
+					key, value = subscriber.get(timeout=STREAM_KEEPALIVE)
+				except Queue.Empty:
+					self.wfile.write(": keep-alive\n\n")
+					self.wfile.flush()
+					continue
+
+				# Send everything that's piled up as one event
+				changes = {key : value}
+				while True:
+					try:
+						key, value = subscriber.get_nowait()
+					except Queue.Empty:
+						break
+					changes[key] = value
+				self.wfile.write("data: {}\n\n".format(json.dumps(changes)))
+				self.wfile.flush()
+
+		except (IOError, socket.error):
+			pass # client went away
+		finally:
+			pB_eDriver.SESSION.unsubscribe(subscriber)
+
+	# Send a complete response. Content-Length is always set so the connection can be kept alive
+	def sendResponse(self, code, body, contentType="text/plain"):
+		self.send_response(code)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		logging.debug("HTTP: " + format % args)
+
+# Handles each connection on its own thread, so one slow utility doesn't hold up every other client
+class pybusHTTPServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
 
 # Server for handling external requests
 def startHTTPServer(kwargs):
 	try:
-		server = HTTPServer(('', PORT_NUMBER), pybusServer)
+		server = pybusHTTPServer(('', PORT_NUMBER), pybusServer)
 		logging.info('Started pybus server on port {}'.format(PORT_NUMBER))
 		server.serve_forever()
 	except Exception, e:
-		print "Error in server: {}".format(e)
\ No newline at end of file
+		print "Error in server: {}".format(e)